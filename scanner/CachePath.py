@@ -1,7 +1,15 @@
+import hashlib
 import os.path
+import re
+from functools import lru_cache
 from datetime import datetime
 
 def message(category, text):
+    if message.quiet:
+        return
+    if message.log is not None:
+        message.log.append((message.level, category, text))
+        return
     if message.level <= 0:
         sep = "  "
     else:
@@ -13,8 +21,25 @@ def message(category, text):
         category,
         max(1, (14 - len(category))) * " ",
         text
-    ))
+    ), flush=True)
 message.level = -1
+message.quiet = False
+# in worker processes, the messages kept for the scanner to print
+message.log = None
+
+# the messages kept since the last take, e.g. by a worker for one photo
+def take_messages():
+    log = message.log
+    message.log = []
+    return log
+
+# prints messages taken in a worker, their levels relative to the current one
+def print_messages(log):
+    current = message.level
+    for level, category, text in log:
+        message.level = current + level
+        message(category, text)
+    message.level = current
 
 def next_level():
     message.level += 1
@@ -24,6 +49,7 @@ def back_level():
 
 def set_cache_path_base(base):
     trim_base.base = base
+    cache_base.cache_clear()
 
 def untrim_base(path):
     return os.path.join(trim_base.base, path)
@@ -38,26 +64,90 @@ def trim_base_custom(path, base):
 def trim_base(path):
     return trim_base_custom(path, trim_base.base)
 
+_cache_base_table = str.maketrans({'/': '-', ' ': '_', '(': None, '&': None, ',': None, ')': None, '#': None, '[': None, ']': None, '"': None, "'": None})
+
+# memoized: the same path is looked up for each of its thumbnails in a row
+@lru_cache(maxsize=4096)
 def cache_base(path):
-    path = trim_base(path).replace('/', '-').replace(' ', '_').replace('(', '').replace('&', '').replace(',', '').replace(')', '').replace('#', '').replace('[', '').replace(']', '').replace('"', '').replace("'", '').replace('_-_', '-').lower()
+    path = trim_base(path).translate(_cache_base_table).replace('_-_', '-').lower()
     path = path.encode('ascii', 'ignore').decode('ascii')  # Ensure ASCII compatibility
-    while "--" in path:
-        path = path.replace("--", "-")
-    while "__" in path:
-        path = path.replace("__", "_")
+    path = re.sub("-{2,}", "-", path)
+    path = re.sub("_{2,}", "_", path)
     if len(path) == 0:
         path = "root"
     return path
 
-def json_cache(path):
-    return cache_base(path) + ".json"
+# In the sharded layout, the files of every album and photo go in a two
+# level subdirectory named after a hash of their cache base, e.g. 3f/a2/. The
+# hash is 32 bit FNV-1a, simple enough for the web client to compute too.
+def set_cache_layout(sharded):
+    cache_shard.sharded = sharded
+    cache_shard.cache_clear()
 
-def image_cache(path, size, square=False):
+@lru_cache(maxsize=4096)
+def cache_shard(base):
+    if not cache_shard.sharded:
+        return ""
+    digest = 0x811c9dc5
+    for c in base.encode('ascii'):
+        digest = ((digest ^ c) * 0x01000193) & 0xffffffff
+    digest = "%08x" % digest
+    return digest[0:2] + "/" + digest[2:4] + "/"
+cache_shard.sharded = False
+
+def json_cache(path, page=None):
+    base = cache_base(path)
+    if page is None:
+        return cache_shard(base) + base + ".json"
+    return cache_shard(base) + base + ".page" + str(page) + ".json"
+
+def image_cache(path, size, square=False, extension="jpg"):
     if square:
         suffix = str(size) + "s"
     else:
         suffix = str(size)
-    return cache_base(path) + "_" + suffix + ".jpg"
+    base = cache_base(path)
+    return cache_shard(base) + base + "_" + suffix + "." + extension
+
+# where a cache file of either layout goes in the current one
+def relocate_cache(name):
+    name = os.path.basename(name)
+    if re.search(r"\.json(\.gz|\.br)?$", name):
+        base = re.sub(r"(\.page\d+)?\.json(\.gz|\.br)?$", "", name)
+    else:
+        base = re.sub(r"_\d+s?\.[a-z]+$", "", name)
+    return cache_shard(base) + name
+
+# Keys of the JSON outputs as the compact format writes them, the web client
+# (010-libphotofloat.js) has the same table to read them back
+short_keys = {
+    "version": "v", "path": "p", "date": "d", "formats": "f", "albums": "a", "photos": "ph",
+    "pageSize": "ps", "pages": "pg", "page": "g", "count": "c", "sample": "sa", "album": "al",
+    "name": "n", "month": "mo", "photo": "pt", "camera": "ca", "key": "k",
+    "dateTimeFile": "tf", "size": "sz", "orientation": "o", "artist": "ar", "copyright": "cr",
+    "make": "mk", "model": "md", "aperture": "ap", "focalLength": "fl", "iso": "is",
+    "exposureTime": "et", "flash": "fh", "lightSource": "ls", "exposureProgram": "ep",
+    "spectralSensitivity": "ss", "meteringMode": "mm", "sensingMethod": "sm",
+    "sceneCaptureType": "sc", "subjectDistanceRange": "sd", "exposureCompensation": "ec",
+    "dateTimeOriginal": "to", "dateTime": "dt"
+}
+
+def shorten_keys(value):
+    if isinstance(value, dict):
+        return {short_keys.get(key, key): shorten_keys(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shorten_keys(item) for item in value]
+    return value
 
 def file_mtime(path):
     return datetime.fromtimestamp(int(os.path.getmtime(path)))
+
+def stat_mtime(stat):
+    return datetime.fromtimestamp(int(stat.st_mtime))
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,185 @@
+import gzip
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from Stats import stats
+from CachePath import shorten_keys, message
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Outputs are written next to their final path and renamed over it, so that
+# an interrupted scan never leaves a truncated file behind. A temporary file
+# left by a killed scan is removed as stale by the next one.
+def temporary_path(path):
+    return path + ".tmp"
+
+def atomic_write(path, text):
+    temporary = temporary_path(path)
+    with open(temporary, 'wb' if isinstance(text, bytes) else 'w') as fp:
+        fp.write(text)
+    stats.count("bytes written", len(text))
+    os.replace(temporary, path)
+
+# Compressed copies of the JSON outputs, next to them, for static hosts to
+# serve as they are (e.g. nginx's gzip_static and brotli_static):
+# {extension: compression}, brotli only if its module is installed.
+compressions = {"gz": lambda data: gzip.compress(data, 9, mtime=0)}
+if brotli is not None:
+    compressions["br"] = lambda data: brotli.compress(data, quality=11)
+
+def supported_compressions(extensions):
+    supported = []
+    for extension in extensions:
+        if extension not in compressions:
+            message("unsupported", f"{extension}: the brotli module isn't installed")
+            continue
+        supported.append(extension)
+    return supported
+
+def set_json_output(compact, compress):
+    write_json.compact = compact
+    write_json.compress = [extension for extension in compressions if extension in compress]
+
+# a JSON output and its compressed copies
+def json_files(path):
+    return [path] + [path + "." + extension for extension in write_json.compress]
+
+# Written only if the contents changed, so that unchanged files keep their
+# mtime and stay cached by browsers and proxies. The compressed copies go
+# first: an interrupted write leaves them newer than the file, never older.
+def write_json(path, data):
+    if write_json.compact:
+        text = json.dumps(shorten_keys(data), separators=(",", ":"))
+    else:
+        text = json.dumps(data)
+    try:
+        with open(path) as fp:
+            unchanged = fp.read() == text
+    except OSError:
+        unchanged = False
+    for extension in write_json.compress:
+        if not unchanged or not os.path.exists(path + "." + extension):
+            atomic_write(path + "." + extension, compressions[extension](text.encode()))
+    if unchanged:
+        stats.count("unchanged files")
+        return
+    atomic_write(path, text)
+write_json.compact = False
+write_json.compress = []
+
+def list_directory(path):
+    # every entry is stat'ed exactly once, the result stays cached in its DirEntry
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                entry.stat()
+            except OSError:
+                continue
+            entries.append(entry)
+    return entries
+
+def snapshot(path):
+    # {name: mtime} of the files, without holding on to a DirEntry per file
+    entries = {}
+    try:
+        it = os.scandir(path)
+    except FileNotFoundError:
+        return entries
+    with it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if not entry.is_dir():
+                    entries[entry.name] = entry.stat().st_mtime
+            except OSError:
+                continue
+    return entries
+
+# hard links share the file when both are on the same filesystem, outputs
+# are never written to in place so they stay independent
+def link_or_copy(source, target):
+    temporary = temporary_path(target)
+    if os.path.lexists(temporary):
+        # left by a killed merge
+        os.unlink(temporary)
+    try:
+        os.link(source, temporary)
+    except OSError:
+        shutil.copyfile(source, temporary)
+    os.replace(temporary, target)
+
+def make_parent(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+# The files of the cache directory by relative path, listed a shard (or, in
+# the flat layout, the whole directory) at a time when first looked up.
+class CacheListing:
+    def __init__(self, path):
+        self._path = path
+        self._shards = {}
+
+    # lists a shard ahead on the lister
+    def prefetch(self, shard, lister):
+        if shard not in self._shards:
+            self._shards[shard] = lister.submit(snapshot, os.path.join(self._path, shard))
+
+    def shard(self, shard):
+        entries = self._shards.get(shard)
+        if entries is None:
+            entries = self._shards[shard] = snapshot(os.path.join(self._path, shard))
+        elif not isinstance(entries, dict):
+            entries = self._shards[shard] = entries.result()
+        return entries
+
+    # shards looked at so far
+    def shards(self):
+        return list(self._shards)
+
+    def get(self, name, default=None):
+        shard, name = os.path.split(name)
+        return self.shard(shard).get(name, default)
+
+    def pop(self, name, default=None):
+        shard, name = os.path.split(name)
+        return self.shard(shard).pop(name, default)
+
+    def __contains__(self, name):
+        shard, name = os.path.split(name)
+        return name in self.shard(shard)
+
+# Lists directories ahead of the walker on a pool of threads: listing a
+# directory queues the listing of all its subdirectories, so that on high
+# latency filesystems siblings are listed concurrently while the walker is
+# still busy with their elders. Only the subdirectories of the directories
+# being walked are listed ahead, not the whole tree, and of those only the
+# ones wanted says the walker will enter.
+class DirectoryLister:
+    def __init__(self, threads, wanted=None):
+        self._pool = ThreadPoolExecutor(threads)
+        self._listings = {}
+        self._wanted = wanted
+
+    def submit(self, function, *args):
+        return self._pool.submit(function, *args)
+
+    def prefetch(self, path):
+        if path not in self._listings:
+            self._listings[path] = self._pool.submit(list_directory, path)
+
+    def list(self, path):
+        self.prefetch(path)
+        entries = self._listings.pop(path).result()
+        for entry in entries:
+            if entry.is_dir() and (self._wanted is None or self._wanted(entry.path)):
+                self.prefetch(entry.path)
+        return entries
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,77 @@
+import os
+from CachePath import *
+from PhotoAlbum import photo_entry
+from FileSystem import write_json, json_files
+
+def camera_name(make, model):
+    if not model:
+        return make or None
+    # most models already start with the maker's name
+    if not make or model.lower().startswith(make.lower()):
+        return model
+    return make + " " + model
+
+# Indexes over all photos, written in one go at the end of a scan from the
+# records kept for each photo: the latest photos, and the photos by month and by camera. Every
+# photo is referred to by the cache key of its album and its name, enough
+# for the client to link to it and to build its thumbnails paths. Buckets
+# are split in a small listing plus one file per bucket.
+class Indexes:
+    directory = "index"
+
+    def __init__(self, latest=100):
+        self.latest = latest
+
+    # what the indexes need to know about a photo
+    @staticmethod
+    def record(photo):
+        return (photo.date, photo.path, camera_name(photo.make, photo.model))
+
+    @staticmethod
+    def _entry(date, path):
+        entry = photo_entry(path)
+        entry["date"] = date.isoformat()
+        return entry
+
+    def write(self, cache_path, records):
+        # newest first
+        records = sorted(records, reverse=True)
+        message("caching", "latest photos")
+        write_json(os.path.join(cache_path, "latest_photos.json"), [Indexes._entry(date, path) for date, path, camera in records[:self.latest]])
+        months = {}
+        cameras = {}
+        for date, path, camera in records:
+            entry = Indexes._entry(date, path)
+            months.setdefault(f"{date.year:04d}-{date.month:02d}", []).append(entry)
+            if camera is not None:
+                # keyed like the files they end up in
+                cameras.setdefault(cache_base(camera), (camera, []))[1].append(entry)
+        index_path = os.path.join(cache_path, Indexes.directory)
+        if not os.path.isdir(index_path):
+            os.mkdir(index_path)
+        written = set()
+        message("caching", "timeline")
+        timeline = []
+        for month, photos in months.items():
+            timeline.append({"month": month, "count": len(photos), "photo": photos[0]})
+            written.update(json_files(self._write_bucket(index_path, "timeline-" + month, photos)))
+        write_json(os.path.join(index_path, "timeline.json"), timeline)
+        written.update(json_files("timeline.json"))
+        message("caching", "cameras")
+        camera_list = []
+        for key, (camera, photos) in sorted(cameras.items(), key=lambda item: (-len(item[1][1]), item[0])):
+            camera_list.append({"camera": camera, "key": key, "count": len(photos), "photo": photos[0]})
+            written.update(json_files(self._write_bucket(index_path, "camera-" + key, photos)))
+        write_json(os.path.join(index_path, "cameras.json"), camera_list)
+        written.update(json_files("cameras.json"))
+        # the index directory is entirely rewritten, anything else in there is stale
+        for name in os.listdir(index_path):
+            if name not in written:
+                message("cleanup", os.path.join(Indexes.directory, name))
+                os.unlink(os.path.join(index_path, name))
+
+    @staticmethod
+    def _write_bucket(index_path, name, photos):
+        name += ".json"
+        write_json(os.path.join(index_path, name), photos)
+        return name
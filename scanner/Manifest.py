@@ -0,0 +1,181 @@
+import json
+import pickle
+import sqlite3
+import time
+from urllib.request import pathname2url
+from PhotoAlbum import Photo
+
+# Record of what the previous scans produced, so that the walker never has to
+# read back the album JSON files: the mtime of every album directory and, for
+# every photo, the size and mtime it was scanned with, its attributes (None if
+# unreadable), the thumbnails generated for it and, when hashing is enabled, a
+# hash of its content. Paths are trimmed.
+class Manifest:
+    name = ".manifest.sqlite"
+    version = 3
+
+    def __init__(self, path, thumb_sizes, thumb_formats, progressive=False):
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        same_thumbs = self.same_thumbs(thumb_sizes, thumb_formats, progressive)
+        thumb_sizes = json.dumps(thumb_sizes)
+        thumb_formats = json.dumps(thumb_formats)
+        version = self.schema_version()
+        if version == 2 and same_thumbs:
+            self._migrate_rationals()
+        # a schema, thumbnail sizes, formats or encoding change invalidates everything recorded
+        elif version != Manifest.version or not same_thumbs:
+            encoded = not self.same_encoding(progressive)
+            self._db.executescript("""
+                DROP TABLE IF EXISTS albums;
+                DROP TABLE IF EXISTS photos;
+                CREATE TABLE albums (path TEXT PRIMARY KEY, mtime INTEGER);
+                CREATE TABLE photos (path TEXT PRIMARY KEY, album TEXT, size INTEGER, mtime INTEGER, attributes BLOB, thumbs TEXT, hash TEXT);
+                CREATE INDEX photos_album ON photos (album);
+                CREATE INDEX photos_hash ON photos (hash);
+                PRAGMA user_version = {};
+            """.format(Manifest.version))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('thumb_sizes', ?)", (thumb_sizes,))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('thumb_formats', ?)", (thumb_formats,))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('thumb_progressive', ?)", (json.dumps(progressive),))
+            if encoded:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('thumbs_encoded', ?)", (str(int(time.time())),))
+            self._db.commit()
+
+    # a manifest to look at only: neither created, nor reset or migrated
+    @staticmethod
+    def read_only(path):
+        manifest = Manifest.__new__(Manifest)
+        manifest._db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(path)), uri=True)
+        return manifest
+
+    # whether the manifest at path was written with these thumbnails, without
+    # resetting it if it wasn't
+    @staticmethod
+    def compatible(path, thumb_sizes, thumb_formats, progressive=False):
+        try:
+            manifest = Manifest.read_only(path)
+            try:
+                return manifest.schema_version() == Manifest.version and manifest.same_thumbs(thumb_sizes, thumb_formats, progressive)
+            finally:
+                manifest.close()
+        except sqlite3.Error:
+            return False
+
+    # whether opening it with these thumbnails forgets all the photos recorded
+    def resets(self, thumb_sizes, thumb_formats, progressive=False):
+        return not self.same_thumbs(thumb_sizes, thumb_formats, progressive) or self.schema_version() not in (2, Manifest.version)
+
+    def schema_version(self):
+        return self._db.execute("PRAGMA user_version").fetchone()[0]
+
+    def same_thumbs(self, thumb_sizes, thumb_formats, progressive=False):
+        # manifests older than the formats and progressive settings only had baseline JPEG thumbnails
+        return self.get_meta("thumb_sizes") == json.dumps(thumb_sizes) and (self.get_meta("thumb_formats") or '["jpg"]') == json.dumps(thumb_formats) and self.same_encoding(progressive)
+
+    def same_encoding(self, progressive):
+        return (self.get_meta("thumb_progressive") or "false") == json.dumps(progressive)
+
+    # the time the encoding of the thumbnails last changed: those cached
+    # before have to be made again, under the same names
+    def thumbs_encoded(self):
+        return int(self.get_meta("thumbs_encoded") or 0)
+
+    # version 3: attributes hold floats instead of PIL rationals
+    def _migrate_rationals(self):
+        rows = self._db.execute("SELECT path, attributes FROM photos WHERE attributes IS NOT NULL").fetchall()
+        for path, attributes in rows:
+            attributes = Photo.normalize_attributes(pickle.loads(attributes))
+            self._db.execute("UPDATE photos SET attributes = ? WHERE path = ?", (pickle.dumps(attributes, pickle.HIGHEST_PROTOCOL), path))
+        self._db.execute("PRAGMA user_version = {}".format(Manifest.version))
+        self._db.commit()
+
+    def get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def album_mtime(self, path):
+        row = self._db.execute("SELECT mtime FROM albums WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_album(self, path, mtime):
+        self._db.execute("INSERT OR REPLACE INTO albums VALUES (?, ?)", (path, mtime))
+
+    def forget_album(self, path):
+        self._db.execute("DELETE FROM albums WHERE path = ?", (path,))
+
+    def forget_albums(self):
+        self._db.execute("DELETE FROM albums")
+
+    # {path: (size, mtime, attributes blob, thumbs, hash)} of the photos of an album
+    def photos(self, album):
+        photos = {}
+        for path, size, mtime, attributes, thumbs, content_hash in self._db.execute("SELECT path, size, mtime, attributes, thumbs, hash FROM photos WHERE album = ?", (album,)):
+            photos[path] = (size, mtime, attributes, thumbs, content_hash)
+        return photos
+
+    # (attributes blob, thumbs) of any readable photo with that content
+    def photo_by_hash(self, size, content_hash):
+        return self._db.execute("SELECT attributes, thumbs FROM photos WHERE size = ? AND hash = ? AND attributes IS NOT NULL", (size, content_hash)).fetchone()
+
+    @staticmethod
+    def thumbs(text):
+        return json.loads(text)
+
+    @staticmethod
+    def attributes(blob):
+        if blob is None:
+            return None
+        return pickle.loads(blob)
+
+    def set_photo(self, path, album, size, mtime, attributes, thumbs, content_hash=None):
+        if attributes is not None:
+            attributes = pickle.dumps(attributes, pickle.HIGHEST_PROTOCOL)
+        self._db.execute("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?)", (path, album, size, mtime, attributes, json.dumps(thumbs), content_hash))
+
+    # rows of all photos, as import_photo takes them
+    def export_photos(self):
+        return self._db.execute("SELECT path, album, size, mtime, attributes, thumbs, hash FROM photos")
+
+    # (size, mtime, thumbs) of every photo
+    def photo_stamps(self):
+        return dict((path, (size, mtime, thumbs)) for path, size, mtime, thumbs in self._db.execute("SELECT path, size, mtime, thumbs FROM photos"))
+
+    def import_photo(self, path, album, size, mtime, attributes, thumbs, content_hash):
+        self._db.execute("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?)", (path, album, size, mtime, attributes, json.dumps(thumbs), content_hash))
+
+    def set_photo_thumbs(self, path, thumbs):
+        self._db.execute("UPDATE photos SET thumbs = ? WHERE path = ?", (json.dumps(thumbs), path))
+
+    # after the cache files moved to another layout
+    def relocate_thumbs(self, relocate):
+        rows = self._db.execute("SELECT path, thumbs FROM photos").fetchall()
+        for path, thumbs in rows:
+            thumbs = [relocate(thumb) for thumb in json.loads(thumbs)]
+            self._db.execute("UPDATE photos SET thumbs = ? WHERE path = ?", (json.dumps(thumbs), path))
+
+    def set_photo_mtime(self, path, mtime):
+        self._db.execute("UPDATE photos SET mtime = ? WHERE path = ?", (mtime, path))
+
+    def remove_photos(self, paths):
+        self._db.executemany("DELETE FROM photos WHERE path = ?", [(path,) for path in paths])
+
+    # forgets about the albums not in paths, and about their photos
+    def retain_albums(self, paths):
+        gone = [(path,) for (path,) in self._db.execute("SELECT path FROM albums") if path not in paths]
+        self._db.executemany("DELETE FROM albums WHERE path = ?", gone)
+        self._db.executemany("DELETE FROM photos WHERE album = ?", gone)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        # uncommitted changes are dropped
+        self._db.close()
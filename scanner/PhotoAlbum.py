@@ -1,20 +1,52 @@
 from CachePath import *
+from FileSystem import write_json, temporary_path, make_parent
+from Stats import stats
 from datetime import datetime
-import json
 import os
 import os.path
-from PIL import Image, TiffImagePlugin
-from PIL.ExifTags import TAGS
-import gc
+import random
+import time
+from PIL import Image, TiffImagePlugin, features
+from PIL.ExifTags import Base, IFD
 import html
 
+def exif_date(value):
+    if isinstance(value, (tuple, list)):
+        value = value[0].strip().partition("\x00")[0]
+    return datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
+
+def exif_number(value):
+    # rationals become plain floats right away, nothing has to convert them later
+    if isinstance(value, TiffImagePlugin.IFDRational):
+        if value.denominator == 0:
+            stats.count("invalid EXIF values")
+            raise ValueError("'nan' detected")
+        return float(value)
+    if isinstance(value, tuple):
+        return tuple(exif_number(item) for item in value)
+    return value
+
+# how indexes and subalbum samples refer to photos
+def photo_entry(path):
+    return {"album": cache_base(os.path.dirname(path)), "name": os.path.basename(path)}
+
 class Album:
+    # version of the JSON written by cache()
+    version = 4
+    # photos sampled from each subalbum, for the client to pick covers from
+    sample_size = 5
+    __slots__ = ("_path", "_photos", "_albums", "_photos_sorted", "_albums_sorted", "_date", "_empty", "_count", "_sample")
+
     def __init__(self, path):
         self._path = trim_base(path)
         self._photos = list()
         self._albums = list()
         self._photos_sorted = True
         self._albums_sorted = True
+        self._date = None
+        self._empty = None
+        self._count = None
+        self._sample = None
 
     @property
     def photos(self):
@@ -35,8 +67,23 @@ class Album:
     def cache_path(self):
         return json_cache(self.path)
 
+    # number of detail pages the album is split into, 0 if it isn't
+    def pages(self, page_size):
+        return Album.page_count(len(self._photos), page_size)
+
+    @staticmethod
+    def page_count(count, page_size):
+        if not page_size or count <= page_size:
+            return 0
+        return (count + page_size - 1) // page_size
+
+    def cache_paths(self, page_size=0):
+        return [self.cache_path] + [json_cache(self.path, page) for page in range(self.pages(page_size))]
+
     @property
     def date(self):
+        if self._date is not None:
+            return self._date
         self._sort()
         if len(self._photos) == 0 and len(self._albums) == 0:
             return datetime(1900, 1, 1)
@@ -67,6 +114,8 @@ class Album:
 
     @property
     def empty(self):
+        if self._empty is not None:
+            return self._empty
         if len(self._photos) != 0:
             return False
         if len(self._albums) == 0:
@@ -76,174 +125,197 @@ class Album:
                 return False
         return True
 
-    def cache(self, base_dir):
-        self._sort()
-        with open(os.path.join(base_dir, self.cache_path), 'w') as fp:
-            json.dump(self, fp, cls=PhotoAlbumEncoder)
+    # number of photos in the album and all its subalbums
+    @property
+    def count(self):
+        if self._count is not None:
+            return self._count
+        return len(self._photos) + sum(album.count for album in self._albums)
 
-    @staticmethod
-    def from_cache(path):
-        with open(path, "r") as fp:
-            dictionary = json.load(fp)
-        return Album.from_dict(dictionary)
+    # paths of up to sample_size photos drawn uniformly from the album and all
+    # its subalbums, seeded by the album path so that unchanged albums keep theirs
+    @property
+    def sample(self):
+        if self._sample is not None:
+            return self._sample
+        rng = random.Random(self._path)
+        photos = sorted(photo.path for photo in self._photos)
+        # (photos not drawn yet, samples of them)
+        sources = [[len(photos), rng.sample(photos, min(Album.sample_size, len(photos)))]]
+        for album in sorted(self._albums, key=lambda album: album.path):
+            sources.append([album.count, list(album.sample)])
+        sample = []
+        while len(sample) < Album.sample_size:
+            left = sum(source[0] for source in sources)
+            if left == 0:
+                break
+            # each of the photos left is as likely to be drawn
+            draw = rng.randrange(left)
+            for source in sources:
+                if draw < source[0]:
+                    source[0] -= 1
+                    sample.append(source[1].pop(0))
+                    break
+                draw -= source[0]
+        return sample
+
+    def release(self):
+        # once cached, only keep what the parent album still needs
+        self._date = self.date
+        self._empty = self.empty
+        self._count = self.count
+        self._sample = self.sample
+        self._photos = list()
+        self._albums = list()
+
+    # all a released album still knows, enough to stand in for it later
+    @property
+    def summary(self):
+        return (self.date, self.empty, self.count, self.sample)
 
     @staticmethod
-    def from_dict(dictionary, cripple=True):
-        album = Album(dictionary["path"])
-        for photo in dictionary["photos"]:
-            album.add_photo(Photo.from_dict(photo, untrim_base(album.path)))
-        if not cripple:
-            for subalbum in dictionary["albums"]:
-                album.add_album(Album.from_dict(subalbum), cripple)
-        album._sort()
+    def from_summary(path, summary):
+        album = Album(path)
+        album._date, album._empty, album._count, album._sample = summary
         return album
 
+    def cache(self, base_dir, page_size=0):
+        # to_dict() only holds JSON types: dumps() runs entirely in the C encoder
+        album = self.to_dict()
+        pages = self.pages(page_size)
+        make_parent(os.path.join(base_dir, self.cache_path))
+        if pages:
+            # big albums: the index only lists what the thumbnails grid needs,
+            # the full attributes are fetched page by page when photos are shown
+            photos = album["photos"]
+            album["photos"] = [Photo.index_dict(photo) for photo in photos]
+            album["pageSize"] = page_size
+            album["pages"] = pages
+            for page in range(pages):
+                write_json(os.path.join(base_dir, json_cache(self.path, page)), {"version": Album.version, "path": self.path, "page": page, "photos": photos[page * page_size:(page + 1) * page_size]})
+        write_json(os.path.join(base_dir, self.cache_path), album)
+
     def to_dict(self, cripple=True):
         self._sort()
         subalbums = []
         if cripple:
             for sub in self._albums:
                 if not sub.empty:
-                    subalbums.append({"path": trim_base_custom(sub.path, self._path), "date": sub.date})
+                    subalbums.append({"path": trim_base_custom(sub.path, self._path), "date": sub.date.isoformat(), "count": sub.count, "sample": [photo_entry(path) for path in sub.sample]})
         else:
             for sub in self._albums:
                 if not sub.empty:
-                    subalbums.append(sub)
-        return {"path": self.path, "date": self.date, "albums": subalbums, "photos": self._photos}
-
-    def photo_from_path(self, path):
-        for photo in self._photos:
-            if trim_base(path) == photo._path:
-                return photo
-        return None
+                    subalbums.append(sub.to_dict(cripple))
+        photos = [photo.to_dict() for photo in self._photos]
+        return {"version": Album.version, "path": self.path, "date": self.date.isoformat(), "formats": Photo.thumb_formats, "albums": subalbums, "photos": photos}
 
 
 class Photo:
     thumb_sizes = [(75, True), (150, True), (640, False), (800, False), (1024, False)]
-
-    def __init__(self, path, thumb_path=None, attributes=None):
+    # every thumbnail is written in each of these formats, JPEG always comes
+    # first as it is what browsers fall back to
+    thumb_formats = ["jpg"]
+    progressive = False
+    # extension: (Pillow format, save options, Pillow feature), by order of preference
+    save_formats = {
+        "avif": ("AVIF", {"quality": 60}, "avif"),
+        "webp": ("WEBP", {"quality": 80, "method": 4}, "webp"),
+        "jpg": ("JPEG", {"quality": 88}, None),
+    }
+    # the attributes are plain fields, None when unknown, written to JSON in this order
+    attribute_names = (
+        "dateTimeFile", "size", "orientation", "artist", "copyright", "make", "model", "aperture",
+        "focalLength", "iso", "exposureTime", "flash", "lightSource", "exposureProgram",
+        "spectralSensitivity", "meteringMode", "sensingMethod", "sceneCaptureType",
+        "subjectDistanceRange", "exposureCompensation", "dateTimeOriginal", "dateTime"
+    )
+    __slots__ = ("_path", "is_valid", "_orientation") + attribute_names
+
+    def __init__(self, path, thumb_path=None, attributes=None, mtime=None, thumb_sizes=None):
         self._path = trim_base(path)
         self.is_valid = True
+        for name in Photo.attribute_names:
+            setattr(self, name, None)
         try:
-            mtime = file_mtime(path)
+            if mtime is None:
+                mtime = file_mtime(path)
         except KeyboardInterrupt:
             raise
         except Exception:
             self.is_valid = False
             return
         if attributes is not None and attributes["dateTimeFile"] >= mtime:
-            self._attributes = attributes
+            for name, value in attributes.items():
+                if name in Photo.attribute_names:
+                    setattr(self, name, value)
             return
-        self._attributes = {}
-        self._attributes["dateTimeFile"] = mtime
+        if thumb_path is None:
+            # outdated entry of a cached album: the walker rescans it, don't decode anything here
+            self.is_valid = False
+            return
+        self.dateTimeFile = mtime
 
         try:
-            image = Image.open(path)
+            # only the header is parsed here, pixels are decoded by _thumbnails if needed
+            with stats.timer("exif"):
+                image = Image.open(path)
         except KeyboardInterrupt:
             raise
         except Exception:
             self.is_valid = False
             return
-        self._metadata(image)
-        self._thumbnails(image, thumb_path, path)
+        with image:
+            with stats.timer("exif"):
+                self._metadata(image)
+            self._thumbnails(image, thumb_path, path, thumb_sizes)
 
     def _metadata(self, image):
-        self._attributes["size"] = image.size
+        self.size = image.size
         self._orientation = 1
         try:
-            info = image._getexif()
+            exif = image.getexif()
+            exif_ifd = exif.get_ifd(IFD.Exif)
         except KeyboardInterrupt:
             raise
         except Exception:
-            print(f"\033[91m Warning: picture {self.path} doesn't have any EXIF data \033[0m")
-            return
-        if not info:
-            print(f"\033[91m Warning: picture {self.path} doesn't have any EXIF data \033[0m")
+            exif = None
+        if not exif:
+            message("no EXIF", self.name)
+            stats.count("photos without EXIF")
             return
 
-        exif = {}
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if isinstance(value, (tuple, list)) and isinstance(decoded, str) and decoded.startswith("DateTime") and len(value) >= 1:
-                value = value[0]
-            if isinstance(value, str):
-                value = value.strip().partition("\x00")[0]
-                if decoded.startswith("DateTime"):
-                    try:
-                        value = datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
-                    except KeyboardInterrupt:
-                        raise
-                    except Exception:
-                        continue
-            exif[decoded] = value
-
-        if "Artist" in exif:
-            self._attributes["artist"] = html.escape(exif["Artist"])
-        else:
-            print(f"\033[91m Warning: picture {self.path} doesn't have any Artist in EXIF data \033[0m")
-        if "Copyright" in exif:
-            self._attributes["copyright"] = html.escape(exif["Copyright"])
-        else:
-            print(f"\033[91m Warning: picture {self.path} doesn't have any Copyright in EXIF data \033[0m")
-
-        if "Orientation" in exif:
-            self._orientation = exif["Orientation"]
+        if Base.Orientation in exif:
+            self._orientation = exif[Base.Orientation]
             if self._orientation in range(5, 9):
-                self._attributes["size"] = (self._attributes["size"][1], self._attributes["size"][0])
+                self.size = (self.size[1], self.size[0])
             if self._orientation - 1 < len(self._metadata_orientation_list):
-                self._attributes["orientation"] = self._metadata_orientation_list[self._orientation - 1]
-        if "Make" in exif:
-            self._attributes["make"] = exif["Make"]
-        if "Model" in exif:
-            self._attributes["model"] = exif["Model"]
-        if "ApertureValue" in exif:
-            self._attributes["aperture"] = exif["ApertureValue"]
-        elif "FNumber" in exif:
-            self._attributes["aperture"] = exif["FNumber"]
-        if "FocalLength" in exif:
-            self._attributes["focalLength"] = exif["FocalLength"]
-        if "ISOSpeedRatings" in exif:
-            self._attributes["iso"] = exif["ISOSpeedRatings"]
-        if "ISO" in exif:
-            self._attributes["iso"] = exif["ISO"]
-        if "PhotographicSensitivity" in exif:
-            self._attributes["iso"] = exif["PhotographicSensitivity"]
-        if "ExposureTime" in exif:
-            self._attributes["exposureTime"] = exif["ExposureTime"]
-        if "Flash" in exif and exif["Flash"] in self._metadata_flash_dictionary:
-            try:
-                self._attributes["flash"] = self._metadata_flash_dictionary[exif["Flash"]]
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                pass
-        if "LightSource" in exif and exif["LightSource"] in self._metadata_light_source_dictionary:
-            try:
-                self._attributes["lightSource"] = self._metadata_light_source_dictionary[exif["LightSource"]]
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                pass
-        if "ExposureProgram" in exif and exif["ExposureProgram"] < len(self._metadata_exposure_list):
-            self._attributes["exposureProgram"] = self._metadata_exposure_list[exif["ExposureProgram"]]
-        if "SpectralSensitivity" in exif:
-            self._attributes["spectralSensitivity"] = exif["SpectralSensitivity"]
-        if "MeteringMode" in exif and exif["MeteringMode"] < len(self._metadata_metering_list):
-            self._attributes["meteringMode"] = self._metadata_metering_list[exif["MeteringMode"]]
-        if "SensingMethod" in exif and exif["SensingMethod"] < len(self._metadata_sensing_method_list):
-            self._attributes["sensingMethod"] = self._metadata_sensing_method_list[exif["SensingMethod"]]
-        if "SceneCaptureType" in exif and exif["SceneCaptureType"] < len(self._metadata_scene_capture_type_list):
-            self._attributes["sceneCaptureType"] = self._metadata_scene_capture_type_list[exif["SceneCaptureType"]]
-        if "SubjectDistanceRange" in exif and exif["SubjectDistanceRange"] < len(self._metadata_subject_distance_range_list):
-            self._attributes["subjectDistanceRange"] = self._metadata_subject_distance_range_list[exif["SubjectDistanceRange"]]
-        if "ExposureCompensation" in exif:
-            self._attributes["exposureCompensation"] = exif["ExposureCompensation"]
-        if "ExposureBiasValue" in exif:
-            self._attributes["exposureCompensation"] = exif["ExposureBiasValue"]
-        if "DateTimeOriginal" in exif:
-            self._attributes["dateTimeOriginal"] = exif["DateTimeOriginal"]
-        if "DateTime" in exif:
-            self._attributes["dateTime"] = exif["DateTime"]
+                self.orientation = self._metadata_orientation_list[self._orientation - 1]
+        # only the tags listed in _metadata_tags are ever decoded
+        for key, tags, convert in self._metadata_tags:
+            for tag in tags:
+                value = exif_ifd.get(tag, exif.get(tag))
+                if value is None:
+                    continue
+                try:
+                    if isinstance(value, str):
+                        value = value.strip().partition("\x00")[0]
+                    else:
+                        value = exif_number(value)
+                    if convert is not None:
+                        value = convert(value)
+                except KeyboardInterrupt:
+                    raise
+                except Exception:
+                    continue
+                setattr(self, key, value)
+                break
+
+        if self.artist is None:
+            message("no artist", self.name)
+            stats.count("photos without artist")
+        if self.copyright is None:
+            message("no copyright", self.name)
+            stats.count("photos without copyright")
 
     _metadata_flash_dictionary = {
     0x0: "No Flash", 0x1: "Fired", 0x5: "Fired, Return not detected", 0x7: "Fired, Return detected",
@@ -281,75 +353,160 @@ class Photo:
     ]
     _metadata_scene_capture_type_list = ["Standard", "Landscape", "Portrait", "Night scene"]
     _metadata_subject_distance_range_list = ["Unknown", "Macro", "Close view", "Distant view"]
+    # attribute: EXIF tags (the first one present wins) and an optional conversion,
+    # values the conversion rejects are skipped
+    _metadata_tags = [
+        ("artist", [Base.Artist], html.escape),
+        ("copyright", [Base.Copyright], html.escape),
+        ("make", [Base.Make], None),
+        ("model", [Base.Model], None),
+        ("aperture", [Base.ApertureValue, Base.FNumber], None),
+        ("focalLength", [Base.FocalLength], None),
+        ("iso", [Base.ISOSpeedRatings], None),
+        ("exposureTime", [Base.ExposureTime], None),
+        ("flash", [Base.Flash], _metadata_flash_dictionary.__getitem__),
+        ("lightSource", [Base.LightSource], _metadata_light_source_dictionary.__getitem__),
+        ("exposureProgram", [Base.ExposureProgram], _metadata_exposure_list.__getitem__),
+        ("spectralSensitivity", [Base.SpectralSensitivity], None),
+        ("meteringMode", [Base.MeteringMode], _metadata_metering_list.__getitem__),
+        ("sensingMethod", [Base.SensingMethod], _metadata_sensing_method_list.__getitem__),
+        ("sceneCaptureType", [Base.SceneCaptureType], _metadata_scene_capture_type_list.__getitem__),
+        ("subjectDistanceRange", [Base.SubjectDistanceRange], _metadata_subject_distance_range_list.__getitem__),
+        ("exposureCompensation", [Base.ExposureBiasValue], None),
+        ("dateTimeOriginal", [Base.DateTimeOriginal], exif_date),
+        ("dateTime", [Base.DateTime], exif_date),
+    ]
+
+    @staticmethod
+    def set_formats(formats, progressive=False):
+        Photo.thumb_formats = ["jpg"] + [extension for extension in Photo.save_formats if extension in formats and extension != "jpg"]
+        Photo.progressive = progressive
+
+    @staticmethod
+    def supported_formats(formats):
+        supported = []
+        for extension in formats:
+            feature = Photo.save_formats[extension][2]
+            if feature is not None and not features.check(feature):
+                message("unsupported", f"{extension}: this Pillow can't write it")
+                continue
+            supported.append(extension)
+        return supported
 
     def _thumbnail(self, image, thumb_path, original_path, size, square=False):
-        thumb_path = os.path.join(thumb_path, image_cache(self._path, size, square))
         info_string = f"{os.path.basename(original_path)} -> {size}px"
         if square:
             info_string += ", square"
         message("thumbing", info_string)
-        if os.path.exists(thumb_path) and file_mtime(thumb_path) >= self._attributes["dateTimeFile"]:
-            return
-        gc.collect()
-        try:
-            image = image.copy()
-        except KeyboardInterrupt:
-            raise
-        except Exception:
-            try:
-                image = image.copy()  # Retry to work around PIL bug
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                message("corrupt image", os.path.basename(original_path))
-                return
-        if square:
-            if image.size[0] > image.size[1]:
-                left = 0
-                top = -(image.size[0] - image.size[1]) / 2
-                right = image.size[0]
-                bottom = image.size[1] + ((image.size[0] - image.size[1]) / 2)
-            else:
-                left = -(image.size[1] - image.size[0]) / 2
-                top = 0
-                right = image.size[0] + ((image.size[1] - image.size[0]) / 2)
-                bottom = image.size[1]
-            image = image.crop((left, top, right, bottom))
-            gc.collect()
-        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        for extension in Photo.thumb_formats:
+            self._save(image, os.path.join(thumb_path, image_cache(self._path, size, square, extension)), extension)
+
+    def _save(self, image, thumb_path, extension):
+        pillow_format, options, feature = Photo.save_formats[extension]
+        if extension == "jpg" and Photo.progressive:
+            options = dict(options, progressive=True, optimize=True)
+        elif extension != "jpg" and image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        temporary = temporary_path(thumb_path)
         try:
-            image.save(thumb_path, "JPEG", quality=88)
+            with stats.timer("encode"):
+                image.save(temporary, pillow_format, **options)
+            stats.count("thumbnails written")
+            stats.count("bytes written", os.path.getsize(temporary))
+            os.replace(temporary, thumb_path)
         except KeyboardInterrupt:
             try:
-                os.unlink(thumb_path)
+                os.unlink(temporary)
             except Exception:
                 pass
             raise
         except Exception:
             message("save failure", os.path.basename(thumb_path))
+            stats.count("save failures")
             try:
-                os.unlink(thumb_path)
+                os.unlink(temporary)
             except Exception:
                 pass
 
-    def _thumbnails(self, image, thumb_path, original_path):
-        mirror = image
+    def _thumbnail_is_fresh(self, thumb_path, size, square):
+        for extension in Photo.thumb_formats:
+            try:
+                if file_mtime(os.path.join(thumb_path, image_cache(self._path, size, square, extension))) < self.dateTimeFile:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    @staticmethod
+    def _square(image):
+        # pad (not crop) to a centered square, the borders end up black
+        if image.size[0] > image.size[1]:
+            left = 0
+            top = -(image.size[0] - image.size[1]) / 2
+            right = image.size[0]
+            bottom = image.size[1] + ((image.size[0] - image.size[1]) / 2)
+        else:
+            left = -(image.size[1] - image.size[0]) / 2
+            top = 0
+            right = image.size[0] + ((image.size[1] - image.size[0]) / 2)
+            bottom = image.size[1]
+        return image.crop((left, top, right, bottom))
+
+    def _orient(self, image):
         if self._orientation == 2:
-            mirror = image.transpose(Image.FLIP_LEFT_RIGHT)
+            return image.transpose(Image.FLIP_LEFT_RIGHT)
         elif self._orientation == 3:
-            mirror = image.transpose(Image.ROTATE_180)
+            return image.transpose(Image.ROTATE_180)
         elif self._orientation == 4:
-            mirror = image.transpose(Image.FLIP_TOP_BOTTOM)
+            return image.transpose(Image.FLIP_TOP_BOTTOM)
         elif self._orientation == 5:
-            mirror = image.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.ROTATE_270)
+            return image.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.ROTATE_270)
         elif self._orientation == 6:
-            mirror = image.transpose(Image.ROTATE_270)
+            return image.transpose(Image.ROTATE_270)
         elif self._orientation == 7:
-            mirror = image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
+            return image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
         elif self._orientation == 8:
-            mirror = image.transpose(Image.ROTATE_90)
-        for size in Photo.thumb_sizes:
-            self._thumbnail(mirror, thumb_path, original_path, size[0], size[1])
+            return image.transpose(Image.ROTATE_90)
+        return image
+
+    def _thumbnails(self, image, thumb_path, original_path, missing=None):
+        # Largest views first, then the squares: every size is scaled down
+        # from the previous one instead of from the full size original.
+        sizes = sorted(Photo.thumb_sizes, key=lambda size: (not size[1], size[0]), reverse=True)
+        if missing is None:
+            missing = [size for size in sizes if not self._thumbnail_is_fresh(thumb_path, size[0], size[1])]
+        if len(missing) == 0:
+            return
+        # sizes larger than the largest missing one are of no use
+        while sizes[0] not in missing:
+            sizes.pop(0)
+        try:
+            # decode once, at the smallest JPEG scale still covering the largest size
+            with stats.timer("decode"):
+                image.draft(None, (sizes[0][0], sizes[0][0]))
+                image.load()
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            message("corrupt image", os.path.basename(original_path))
+            stats.count("corrupt images")
+            return
+        stats.count("photos decoded")
+        # all the thumbnails of a photo share a shard
+        make_parent(os.path.join(thumb_path, image_cache(self._path, *sizes[0])))
+        oriented = False
+        for size, square in sizes:
+            start = time.perf_counter()
+            if square and image.size[0] != image.size[1]:
+                image = self._square(image)
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            if not oriented:
+                # the bounding box is square, so orienting the first (small) step is enough
+                image = self._orient(image)
+                oriented = True
+            stats.add_time("resize", time.perf_counter() - start)
+            if (size, square) in missing:
+                self._thumbnail(image, thumb_path, original_path, size, square)
 
     @property
     def name(self):
@@ -364,56 +521,58 @@ class Photo:
 
     @property
     def image_caches(self):
-        return [image_cache(self._path, size[0], size[1]) for size in Photo.thumb_sizes]
+        return Photo.thumb_caches(self._path)
+
+    @staticmethod
+    def thumb_caches(path, sizes=None):
+        if sizes is None:
+            sizes = Photo.thumb_sizes
+        return [image_cache(path, size[0], size[1], extension) for size in sizes for extension in Photo.thumb_formats]
 
     @property
     def date(self):
         if not self.is_valid:
             return datetime(1900, 1, 1)
-        if "dateTimeOriginal" in self._attributes:
-            return self._attributes["dateTimeOriginal"]
-        elif "dateTime" in self._attributes:
-            return self._attributes["dateTime"]
-        return self._attributes["dateTimeFile"]
+        if self.dateTimeOriginal is not None:
+            return self.dateTimeOriginal
+        elif self.dateTime is not None:
+            return self.dateTime
+        return self.dateTimeFile
 
     def __lt__(self, other):
         return self.name < other.name
 
     @property
     def attributes(self):
-        return self._attributes
-
-    @staticmethod
-    def from_dict(dictionary, basepath):
-        del dictionary["date"]
-        path = os.path.join(basepath, dictionary["name"])
-        del dictionary["name"]
-        for key, value in dictionary.items():
-            if key.startswith("dateTime"):
-                try:
-                    dictionary[key] = datetime.strptime(dictionary[key], "%a %b %d %H:%M:%S %Y")
-                except KeyboardInterrupt:
-                    raise
-                except Exception:
-                    pass
-        return Photo(path, None, dictionary)
+        attributes = {}
+        for name in Photo.attribute_names:
+            value = getattr(self, name)
+            if value is not None:
+                attributes[name] = value
+        return attributes
 
     def to_dict(self):
-        photo = {"name": self.name, "date": self.date}
-        photo.update(self.attributes)
+        photo = {"name": self.name, "date": self.date.isoformat()}
+        for name in Photo.attribute_names:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            photo[name] = value
         return photo
 
+    @staticmethod
+    def index_dict(photo):
+        return {key: photo[key] for key in ("name", "date", "size") if key in photo}
 
-class PhotoAlbumEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.strftime("%a %b %d %H:%M:%S %Y")
-        if isinstance(obj, Album) or isinstance(obj, Photo):
-            return obj.to_dict()
-        if isinstance(obj, TiffImagePlugin.IFDRational):
-            if obj.denominator == 0:
-                print("\033[91m Warning: 'nan' detected \033[0m")
-                return float('nan')  # Return NaN to handle division by zero gracefully
-            return float(obj)
-        return super().default(obj)
+    # attributes recorded before exif_number existed still hold rationals
+    @staticmethod
+    def normalize_attributes(attributes):
+        for key, value in list(attributes.items()):
+            try:
+                attributes[key] = exif_number(value)
+            except ValueError:
+                del attributes[key]
+        return attributes
 
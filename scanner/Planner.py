@@ -0,0 +1,234 @@
+import json
+import os
+import time
+from PhotoAlbum import Photo, Album
+from Manifest import Manifest
+from TreeWalker import is_shard, is_top_file, top_files, photo_hit, reusable_photo, thumbs_to_make, missing_views
+from FileSystem import list_directory, set_json_output, json_files
+from CachePath import *
+
+def size_name(size):
+    return str(size[0]) + ("s" if size[1] else "")
+
+# What a scan with the same options would do, found out from the stats of the
+# album tree and what the manifest recorded, without opening any photo but
+# those the scan would hash, with --validate hash: which
+# albums are fully, partially or not cached, the photos to scan and the
+# thumbnails to make for each, the album JSON to write and the stale cache
+# files to remove. Nothing is written. The time is estimated from the
+# throughput measured by the previous scans.
+class Planner:
+    def __init__(self, album_path, cache_path, jobs=1, validate="mtime", page_size=0, thumb_formats=("jpg",), progressive=False, sharded=False, compact=False, compress=()):
+        self.album_path = os.path.abspath(album_path)
+        self.cache_path = os.path.abspath(cache_path)
+        set_cache_path_base(self.album_path)
+        set_cache_layout(sharded)
+        Photo.set_formats(thumb_formats, progressive)
+        set_json_output(compact, compress)
+        self.compact = compact
+        self.jobs = jobs
+        self.validate = validate
+        self.page_size = page_size
+        # why more than the changes since the last scan is done
+        self.reasons = []
+        self.albums = {"full": [], "partial": [], "miss": []}
+        self.albums_written = []
+        # {photo path: names of the thumbnail sizes to make}, the photos scanned
+        self.scans = {}
+        # photos whose metadata is read, not just their thumbnails made
+        self.misses = []
+        # with --validate hash, photos whose mtime changed but not their contents
+        self.verify = []
+        # with --validate hash, photos whose thumbnails are copied from the same
+        # contents under another name
+        self.reused = []
+        self.removed_photos = []
+        self.needed = set()
+        for name in top_files:
+            self.needed.update(json_files(name))
+        self.throughput = {}
+        self.manifest = None
+        path = os.path.join(self.cache_path, Manifest.name)
+        if os.path.exists(path):
+            self.manifest = Manifest.read_only(path)
+        try:
+            self.plan(sharded)
+        finally:
+            if self.manifest is not None:
+                self.manifest.close()
+
+    def plan(self, sharded):
+        self.known_photos = self.known_albums = self.manifest is not None
+        # thumbnails cached before were encoded otherwise
+        self.thumbs_encoded = 0
+        if self.manifest is None:
+            self.reasons.append("no manifest in the cache: every photo is scanned")
+            if Photo.progressive:
+                self.thumbs_encoded = int(time.time())
+        else:
+            self.throughput = json.loads(self.manifest.get_meta("throughput") or "{}")
+            if self.manifest.resets(Photo.thumb_sizes, Photo.thumb_formats, Photo.progressive):
+                self.reasons.append("thumbnail sizes, formats, JPEG encoding or manifest version changed: every photo is scanned again")
+                self.known_photos = self.known_albums = False
+            if not self.manifest.same_encoding(Photo.progressive):
+                self.reasons.append("JPEG thumbnails are encoded again")
+                self.thumbs_encoded = int(time.time())
+            else:
+                self.thumbs_encoded = self.manifest.thumbs_encoded()
+            json_format = "compact" if self.compact else "plain"
+            if self.manifest.get_meta("album_version") != str(Album.version) or self.manifest.get_meta("page_size") != str(self.page_size) or (self.manifest.get_meta("json_format") or "plain") != json_format:
+                self.reasons.append("album JSON format, keys or page size changed: every album is written again")
+                self.known_albums = False
+            layout = "sharded" if sharded else "flat"
+            if (self.manifest.get_meta("cache_layout") or "flat") != layout:
+                self.reasons.append("cache files are moved to the {} layout".format(layout))
+        self.cache_entries = self.list_cache()
+        self.walk(self.album_path, os.stat(self.album_path))
+        self.stale = sorted(name for name in self.cache_entries if name not in self.needed)
+
+    # {name in the layout of this scan: mtime} of the files of the cache, in either layout
+    def list_cache(self):
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.cache_path):
+            if dirpath == self.cache_path:
+                dirnames[:] = [name for name in dirnames if is_shard(name)]
+            for name in filenames:
+                if name.startswith('.') or (dirpath == self.cache_path and name in top_files):
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(dirpath, name)).st_mtime
+                except OSError:
+                    continue
+                if dirpath == self.cache_path and is_top_file(name):
+                    entries[name] = mtime
+                else:
+                    entries[relocate_cache(name)] = mtime
+        return entries
+
+    def walk(self, path, stat):
+        try:
+            entries = list_directory(path)
+        except OSError:
+            return None
+        album = trim_base(path)
+        album_mtime = int(stat.st_mtime)
+        cached_photos = {}
+        if self.known_photos:
+            cached_photos = self.manifest.photos(album)
+        changed = not self.known_albums or self.manifest.album_mtime(album) != album_mtime
+        if not changed:
+            self.albums["full"].append(album)
+        elif cached_photos:
+            self.albums["partial"].append(album)
+        else:
+            self.albums["miss"].append(album)
+        empty = True
+        photos = 0
+        for entry in entries:
+            if entry.is_dir():
+                subalbum = self.walk(entry.path, entry.stat())
+                if subalbum is not None:
+                    changed = changed or subalbum[0]
+                    empty = empty and subalbum[1]
+            elif entry.is_file():
+                photo = trim_base(entry.path)
+                stat = entry.stat()
+                cached_photo = cached_photos.pop(photo, None)
+                cache_hit, content_hash = False, None
+                if self.known_photos:
+                    # with no photos recorded, there are no contents to compare with
+                    cache_hit, content_hash = photo_hit(entry.path, stat, cached_photo, self.validate)
+                if cache_hit and content_hash is not None:
+                    self.verify.append(photo)
+                if cache_hit:
+                    if cached_photo[2] is None:
+                        # unreadable
+                        continue
+                    thumbs = Manifest.thumbs(cached_photo[3])
+                    if len(thumbs) < len(Photo.thumb_caches(photo)):
+                        # views left over by a scan that ran out of time
+                        self.scans[photo] = [size_name(size) for size in missing_views(photo, thumbs)]
+                elif content_hash is not None and reusable_photo(self.manifest, photo, stat, content_hash, lambda name: name in self.cache_entries):
+                    changed = True
+                    self.reused.append(photo)
+                else:
+                    changed = True
+                    self.misses.append(photo)
+                    self.scans[photo] = [size_name(size) for size in thumbs_to_make(photo, stat, self.cache_entries, self.validate, self.thumbs_encoded)]
+                photos += 1
+                self.needed.update(Photo.thumb_caches(photo))
+        if cached_photos:
+            changed = True
+            self.removed_photos.extend(cached_photos)
+        empty = empty and photos == 0
+        if not empty:
+            caches = [json_cache(album)] + [json_cache(album, page) for page in range(Album.page_count(photos, self.page_size))]
+            caches = [name for cache in caches for name in json_files(cache)]
+            self.needed.update(caches)
+            if changed or not all(cache in self.cache_entries for cache in caches):
+                self.albums_written.append(album)
+        return changed, empty
+
+    @property
+    def thumbnails(self):
+        return sum(len(sizes) for sizes in self.scans.values()) * len(Photo.thumb_formats)
+
+    # seconds, or None if no scan measured its throughput yet
+    def estimate(self):
+        if not self.throughput:
+            return None
+        albums = sum(len(albums) for albums in self.albums.values())
+        decoded = sum(1 for sizes in self.scans.values() if sizes)
+        # photos are scanned in parallel, the walk isn't
+        work = len(self.scans) * self.throughput.get("photo", 0) + decoded * self.throughput.get("decode", 0) + self.thumbnails * self.throughput.get("thumbnail", 0)
+        return albums * self.throughput.get("album", 0) + work / self.jobs
+
+    def report(self):
+        estimate = self.estimate()
+        return {
+            "reasons": self.reasons,
+            "albums": self.albums,
+            "albums_written": self.albums_written,
+            "photos_scanned": self.scans,
+            "photos_missed": self.misses,
+            "photos_verified": self.verify,
+            "photos_reused": self.reused,
+            "photos_removed": self.removed_photos,
+            "thumbnails": self.thumbnails,
+            "stale_files": self.stale,
+            "jobs": self.jobs,
+            "throughput": self.throughput,
+            "estimated_seconds": None if estimate is None else round(estimate, 1),
+        }
+
+    def log(self):
+        for album in self.albums["partial"]:
+            message("partial cache", album)
+        for album in self.albums["miss"]:
+            message("not cached", album)
+        for photo, sizes in self.scans.items():
+            message("scan", "{} ({})".format(photo, ", ".join(sizes) or "metadata only"))
+        for photo in self.verify:
+            message("unchanged", photo)
+        for photo in self.reused:
+            message("reuse", photo)
+        for album in self.albums_written:
+            message("write", json_cache(album))
+        for name in self.stale:
+            message("stale", name)
+
+    def summary(self):
+        lines = list(self.reasons)
+        lines.append("albums: {} fully cached, {} partially, {} not cached; {} to write".format(
+            len(self.albums["full"]), len(self.albums["partial"]), len(self.albums["miss"]), len(self.albums_written)))
+        lines.append("photos: {} to scan, {} of them new or changed; {} thumbnails to make; {} removed".format(
+            len(self.scans), len(self.misses), self.thumbnails, len(self.removed_photos)))
+        if self.verify or self.reused:
+            lines.append("photos: {} with a new mtime but the same contents; {} copied from the same contents under another name".format(len(self.verify), len(self.reused)))
+        lines.append("stale cache files: {}".format(len(self.stale)))
+        estimate = self.estimate()
+        if estimate is None:
+            lines.append("estimate: none, no scan measured its throughput yet")
+        else:
+            lines.append("estimate: {:.1f}s with {} jobs".format(estimate, self.jobs))
+        return lines
@@ -0,0 +1,57 @@
+import json
+import os
+from PhotoAlbum import Photo
+from Manifest import Manifest
+from TreeWalker import migrate_cache
+from FileSystem import link_or_copy, make_parent
+from CachePath import *
+
+# Brings the photos scanned by shards (see TreeWalker's shard) into a cache:
+# their thumbnails are linked, or copied across filesystems, and their rows
+# added to its manifest. A scan of the cache then finds every photo already
+# done and only writes the album JSON, the global lists and cleans up, and
+# scans whatever no shard did. The albums of the photos merged are forgotten:
+# their directory mtime doesn't tell about photos edited in place, their JSON
+# is written again. Photos are only cache hits if the shards saw the same
+# files: the same mtimes, or the same contents with --validate hash.
+def merge_shards(shard_paths, cache_path, thumb_formats=("jpg",), progressive=False, sharded=False):
+    cache_path = os.path.abspath(cache_path)
+    Photo.set_formats(thumb_formats, progressive)
+    set_cache_layout(sharded)
+    manifest = Manifest(os.path.join(cache_path, Manifest.name), Photo.thumb_sizes, Photo.thumb_formats, Photo.progressive)
+    try:
+        layout = "sharded" if sharded else "flat"
+        if (manifest.get_meta("cache_layout") or "flat") != layout:
+            migrate_cache(cache_path, manifest, layout)
+        known = manifest.photo_stamps()
+        for shard_path in shard_paths:
+            shard_path = os.path.abspath(shard_path)
+            path = os.path.join(shard_path, Manifest.name)
+            if not Manifest.compatible(path, Photo.thumb_sizes, Photo.thumb_formats, Photo.progressive):
+                message("incompatible", "{}: not scanned with the same thumbnails, skipped".format(shard_path))
+                continue
+            message("merging", shard_path)
+            shard = Manifest(path, Photo.thumb_sizes, Photo.thumb_formats, Photo.progressive)
+            merged = 0
+            for photo, album, size, mtime, attributes, thumbs, content_hash in shard.export_photos():
+                # names in the layout of this cache, whatever the shard's
+                thumbs = [(thumb, relocate_cache(thumb)) for thumb in json.loads(thumbs)]
+                targets = [target for source, target in thumbs]
+                if known.get(photo) == (size, mtime, json.dumps(targets)):
+                    continue
+                targets = []
+                for source, target in thumbs:
+                    if not os.path.exists(os.path.join(shard_path, source)):
+                        # the scan of the cache makes it again
+                        continue
+                    make_parent(os.path.join(cache_path, target))
+                    link_or_copy(os.path.join(shard_path, source), os.path.join(cache_path, target))
+                    targets.append(target)
+                manifest.import_photo(photo, album, size, mtime, attributes, targets, content_hash)
+                manifest.forget_album(album)
+                merged += 1
+            shard.close()
+            message("merged", "{} photos from {}".format(merged, shard_path))
+        manifest.commit()
+    finally:
+        manifest.close()
@@ -0,0 +1,77 @@
+import heapq
+import os
+import time
+from contextlib import contextmanager
+
+# Where the time of a scan goes: seconds spent in each phase, counters of
+# what was done, and the slowest photos and albums. Worker processes collect
+# their own and send them back with every photo they scanned, so the phases
+# done in parallel can add up to more than the wall time. An album's time is
+# the time spent on its photos.
+class Stats:
+    slowest = 20
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        # heap of (seconds, path) of the slowest photos
+        self.files = []
+        self.albums = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def photo_time(self, path, seconds):
+        self._slow_photo(seconds, path)
+        self._album_time(os.path.dirname(path), seconds)
+
+    def _slow_photo(self, seconds, path):
+        if len(self.files) < Stats.slowest:
+            heapq.heappush(self.files, (seconds, path))
+        else:
+            heapq.heappushpop(self.files, (seconds, path))
+
+    def _album_time(self, album, seconds):
+        self.albums[album] = self.albums.get(album, 0) + seconds
+
+    # what was collected since the last take, e.g. by a worker for one photo
+    def take(self):
+        data = (self.timers, self.counters, self.files, self.albums)
+        self.reset()
+        return data
+
+    def merge(self, data):
+        timers, counters, files, albums = data
+        for name, seconds in timers.items():
+            self.add_time(name, seconds)
+        for name, n in counters.items():
+            self.count(name, n)
+        for seconds, path in files:
+            self._slow_photo(seconds, path)
+        for album, seconds in albums.items():
+            self._album_time(album, seconds)
+
+    def report(self):
+        albums = heapq.nlargest(Stats.slowest, self.albums.items(), key=lambda item: item[1])
+        return {
+            "phases": dict((name, round(seconds, 4)) for name, seconds in sorted(self.timers.items())),
+            "counters": dict(sorted(self.counters.items())),
+            "slowest_photos": [{"path": path, "seconds": round(seconds, 4)} for seconds, path in sorted(self.files, reverse=True)],
+            "slowest_albums": [{"path": path, "seconds": round(seconds, 4)} for path, seconds in albums],
+        }
+
+stats = Stats()
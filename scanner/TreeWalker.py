@@ -1,119 +1,601 @@
+import hashlib
+import multiprocessing
 import os
+import shutil
 import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
-from PhotoAlbum import Photo, Album, PhotoAlbumEncoder
+from PhotoAlbum import Photo, Album
+from Manifest import Manifest
+from Indexes import Indexes
+from Stats import stats
+from FileSystem import DirectoryLister, CacheListing, set_json_output, write_json, json_files, temporary_path, make_parent
 from CachePath import *
 import json
 
+def init_worker(album_path, thumb_formats, progressive, sharded, quiet):
+    message.quiet = quiet
+    # sent back with every photo and printed by the scanner, in walk order:
+    # levels are relative to the photo's
+    message.log = []
+    message.level = 0
+    set_cache_path_base(album_path)
+    set_cache_layout(sharded)
+    Photo.set_formats(thumb_formats, progressive)
+
+def scan_photo(entry, cache_path, mtime, sizes):
+    start = time.perf_counter()
+    photo = Photo(entry, cache_path, None, mtime, sizes)
+    stats.count("photos scanned")
+    stats.photo_time(photo.path, time.perf_counter() - start)
+    return photo
+
+# in a worker, the stats and messages of the photo go back with it
+def scan_photo_in_worker(entry, cache_path, mtime, sizes):
+    photo = scan_photo(entry, cache_path, mtime, sizes)
+    return photo, stats.take(), take_messages()
+
+# Only compact records outlive the albums, one per album: its summary, the
+# paths of its photos, the names of the cache files it needs and its photos'
+# index records. The global lists are written from these, and a watching
+# scanner keeps them between scans so that unchanged albums are not walked
+# again: their summary stands in for them in their parent.
+class ScanState:
+    def __init__(self):
+        # {album path: (summary, photos, cache files, index records)}
+        self.albums = {}
+
+    def set_album(self, path, summary, photos, files, records):
+        self.albums[path] = (summary, photos, files, records)
+
+    def summary(self, path):
+        return self.albums[path][0]
+
+    # forgets the subalbums of path that are gone, with all their subalbums,
+    # returns the cache files they needed
+    def prune(self, path, subalbums):
+        files = []
+        for album in list(self.albums):
+            if album != path and os.path.dirname(album) == path and album not in subalbums:
+                message("removed", album)
+                for key in list(self.albums):
+                    if key == album or key.startswith(album + "/"):
+                        files.extend(self.albums.pop(key)[2])
+        return files
+
+    def photos(self):
+        for summary, photos, files, records in self.albums.values():
+            yield from photos
+
+    def files(self):
+        for summary, photos, files, records in self.albums.values():
+            yield from files
+
+    def records(self):
+        for summary, photos, files, records in self.albums.values():
+            yield from records
+
+def is_shard(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+# files at the top of the cache, whatever its layout
+top_files = ["all_photos.json", "latest_photos.json", "layout.json", Manifest.name]
+
+def is_top_file(name):
+    # or a compressed copy of one
+    return name in top_files or os.path.splitext(name)[0] in top_files
+
+# Moves the album and photo files to the other layout, the manifest keeps
+# track of the thumbnails by name. Renaming makes it cheap, and safe to do
+# again if interrupted.
+def migrate_cache(cache_path, manifest, layout):
+    message("migrating", "cache to the {} layout".format(layout))
+    for dirpath, dirnames, filenames in os.walk(cache_path):
+        if dirpath == cache_path:
+            dirnames[:] = [name for name in dirnames if is_shard(name)]
+        for name in filenames:
+            if name.startswith('.') or (dirpath == cache_path and is_top_file(name)):
+                continue
+            source = os.path.relpath(os.path.join(dirpath, name), cache_path)
+            target = relocate_cache(source)
+            if target != source:
+                make_parent(os.path.join(cache_path, target))
+                os.replace(os.path.join(cache_path, source), os.path.join(cache_path, target))
+    for dirpath, dirnames, filenames in os.walk(cache_path, topdown=False):
+        if dirpath != cache_path and is_shard(os.path.basename(dirpath)) and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    manifest.relocate_thumbs(relocate_cache)
+    manifest.set_meta("cache_layout", layout)
+    manifest.commit()
+
+# Scans can be split over several machines, each one only scanning the
+# photos of its own shard: the shard of a photo only depends on its path in
+# the album tree, wherever the tree is mounted.
+def scan_shard(path, count):
+    return int.from_bytes(hashlib.blake2b(path.encode("utf-8"), digest_size=8).digest(), "big") % count
+
+# Whether a photo is the one the manifest recorded, from its stat alone:
+# True or False, or None if only its contents can tell.
+def photo_unchanged(stat, cached_photo, validate):
+    if not cached_photo or cached_photo[0] != stat.st_size:
+        return False
+    if validate == "hash":
+        # checkouts reset mtimes: only trust them when untouched, otherwise compare contents
+        if int(stat.st_mtime) == cached_photo[1]:
+            return True
+        return None if cached_photo[4] is not None else False
+    return int(stat.st_mtime) <= cached_photo[1]
+
+# Whether a photo is the one the manifest recorded, and its content hash if
+# it was read: by hash, a photo with a new mtime is read to tell, and so is
+# any other miss, its contents may be known under another name.
+def photo_hit(path, stat, cached_photo, validate):
+    cache_hit = photo_unchanged(stat, cached_photo, validate)
+    content_hash = None
+    if validate == "hash" and not cache_hit:
+        content_hash = file_hash(path)
+        cache_hit = cache_hit is None and content_hash == cached_photo[4]
+    return cache_hit, content_hash
+
+# (attributes, thumbnails) of the same contents already scanned under another
+# name (copied, moved or renamed photo), if all its thumbnails are cached
+def reusable_photo(manifest, photo, stat, content_hash, cached):
+    known = manifest.photo_by_hash(stat.st_size, content_hash)
+    if known is None:
+        return None
+    sources = Manifest.thumbs(known[1])
+    if len(sources) != len(Photo.thumb_caches(photo)) or not all(cached(source) for source in sources):
+        return None
+    return known[0], sources
+
+# the thumbnail sizes to make for a missed photo that isn't reused
+def thumbs_to_make(photo, stat, cache_entries, validate, encoded=0):
+    if validate == "hash":
+        # whatever is cached under its name was made from other contents
+        return Photo.thumb_sizes
+    return missing_thumbs(photo, stat, cache_entries, encoded)
+
+# the thumbnail sizes of a photo missing from a listing of the cache, or older
+# than the photo or than the encoding: judged from the listing, sparing a stat
+# per thumbnail
+def missing_thumbs(photo, stat, cache_entries, encoded=0):
+    missing = []
+    for size in Photo.thumb_sizes:
+        for extension in Photo.thumb_formats:
+            thumb_mtime = cache_entries.get(image_cache(photo, size[0], size[1], extension))
+            if thumb_mtime is None or int(thumb_mtime) < max(int(stat.st_mtime), encoded):
+                missing.append(size)
+                break
+    return missing
+
+# the thumbnail sizes of a photo of which some format isn't among thumbs
+def missing_views(photo, thumbs):
+    thumbs = set(thumbs)
+    return [size for size in Photo.thumb_sizes if not thumbs.issuperset(Photo.thumb_caches(photo, [size]))]
+
 class TreeWalker:
-    def __init__(self, album_path, cache_path):
+    # seconds between commits of the manifest
+    checkpoint_interval = 30
+
+    # Without a state, the whole tree is walked. Given the state of a previous
+    # scan and the directories changed since, only those and their ancestors
+    # are walked again. Given a shard (index, count), only the photos of that
+    # shard are scanned and no album JSON nor global lists are written: that
+    # is left to a merge of the shards' caches.
+    def __init__(self, album_path, cache_path, jobs=1, validate="mtime", list_threads=8, page_size=0, thumb_formats=("jpg",), progressive=False, latest=100, time_budget=None, sharded=False, compact=False, compress=(), shard=None, state=None, changed=None):
         self.album_path = os.path.abspath(album_path)
         self.cache_path = os.path.abspath(cache_path)
         set_cache_path_base(self.album_path)
-        self.all_albums = []
-        self.all_photos = []
-        self.walk(self.album_path)
-        self.big_lists()
-        self.remove_stale()
+        set_cache_layout(sharded)
+        self.sharded = sharded
+        self.compact = compact
+        set_json_output(compact, compress)
+        self.shard = shard
+        Photo.set_formats(thumb_formats, progressive)
+        self.state = ScanState() if state is None else state
+        self.walk_paths = None
+        if changed is not None:
+            self.walk_paths = set()
+            for path in changed:
+                path = trim_base(path)
+                self.walk_paths.add(path)
+                while path:
+                    path = os.path.dirname(path)
+                    self.walk_paths.add(path)
+        self.indexes = Indexes(latest)
+        # albums waiting for their photos or for an elder to be cached, in the
+        # order a serial walk would have cached them
+        self.pending_albums = deque()
+        self.in_flight = set()
+        self.max_in_flight = 4 * jobs
+        # albums walked but not cached yet
+        self.open_albums = set()
+        self.last_checkpoint = time.monotonic()
+        self.changed_albums = set()
+        self.removed_photos = []
+        # cache files of the photos and albums gone, in watched rescans
+        self.removed_files = []
+        self.validate = validate
+        # With a time budget, the grid thumbnails of every photo come first
+        # and the views are made afterwards, until the time runs out. Views
+        # left over are remembered by the manifest and made by the next scans.
+        self.deadline = None
+        if time_budget is not None:
+            self.deadline = time.monotonic() + time_budget
+        self.deferred_views = []
+        self.page_size = page_size
+        self.manifest = Manifest(os.path.join(self.cache_path, Manifest.name), Photo.thumb_sizes, Photo.thumb_formats, Photo.progressive)
+        self.thumbs_encoded = self.manifest.thumbs_encoded()
+        # album JSON written in an older format, paginated differently or
+        # with other keys is rewritten even if unchanged: forgotten albums all
+        # count as changed
+        json_format = "compact" if compact else "plain"
+        if self.manifest.get_meta("album_version") != str(Album.version) or self.manifest.get_meta("page_size") != str(page_size) or (self.manifest.get_meta("json_format") or "plain") != json_format:
+            self.manifest.forget_albums()
+            self.manifest.set_meta("album_version", str(Album.version))
+            self.manifest.set_meta("page_size", str(page_size))
+            self.manifest.set_meta("json_format", json_format)
+        layout = "sharded" if sharded else "flat"
+        if (self.manifest.get_meta("cache_layout") or "flat") != layout:
+            migrate_cache(self.cache_path, self.manifest, layout)
+        self.lister = DirectoryLister(list_threads, self.walks)
+        self.pool = None
+        if jobs > 1:
+            # workers are started on the first photo, once the listing
+            # threads run: forking the scanner then would copy their locks
+            self.pool = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("forkserver"), initializer=init_worker, initargs=(self.album_path, Photo.thumb_formats, Photo.progressive, sharded, message.quiet))
+        try:
+            self.cache_entries = CacheListing(self.cache_path)
+            if not sharded:
+                self.cache_entries.prefetch("", self.lister)
+            self.lister.prefetch(self.album_path)
+            self.walk(self.album_path, os.stat(self.album_path))
+            self.drain(True)
+            self.deferred_thumbnails()
+            self.manifest.remove_photos(self.removed_photos)
+            self.manifest.retain_albums(self.state.albums)
+            self.record_throughput()
+            self.manifest.commit()
+        except KeyboardInterrupt:
+            # keep what's done for the next scan to resume from
+            self.checkpoint()
+            raise
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+            self.lister.shutdown()
+            self.manifest.close()
+        if shard is None:
+            with stats.timer("json write"):
+                self.big_lists()
+        with stats.timer("stale cleanup"):
+            self.remove_stale()
         message("complete", "")
 
-    def walk(self, path):
+    def walk(self, path, stat):
         next_level()
-        if not os.access(path, os.R_OK | os.X_OK):
+        try:
+            with stats.timer("walk"):
+                entries = self.lister.list(path)
+        except KeyboardInterrupt:
+            raise
+        except OSError:
             message("access denied", os.path.basename(path))
             back_level()
             return None
         message("walking", os.path.basename(path))
-        cache = os.path.join(self.cache_path, json_cache(path))
-        cached = False
-        cached_album = None
-        if os.path.exists(cache):
-            try:
-                cached_album = Album.from_cache(cache)
-                if file_mtime(path) <= file_mtime(cache):
-                    message("full cache", os.path.basename(path))
-                    cached = True
-                    album = cached_album
-                    for photo in album.photos:
-                        self.all_photos.append(photo)
-                else:
-                    message("partial cache", os.path.basename(path))
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                message("corrupt cache", os.path.basename(path))
-                cached_album = None
-        if not cached:
-            album = Album(path)
-        for entry in os.listdir(path):
-            if entry.startswith('.'):
-                continue
-            try:
-                entry = entry  # No decoding needed in Python 3
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                next_level()
-                message("unicode error", entry.encode("utf-8", "replace").decode("utf-8"))
-                back_level()
-                continue
-            entry = os.path.join(path, entry)
-            if os.path.isdir(entry):
-                next_walked_album = self.walk(entry)
+        stats.count("albums walked")
+        album = Album(path)
+        self.open_albums.add(album.path)
+        album_mtime = int(stat.st_mtime)
+        with stats.timer("cache load"):
+            cached_photos = self.manifest.photos(album.path)
+            # adding or removing photos or subalbums changes the directory mtime
+            changed = self.manifest.album_mtime(album.path) != album_mtime
+        if not changed:
+            message("full cache", os.path.basename(path))
+            stats.count("albums fully cached")
+        elif cached_photos:
+            message("partial cache", os.path.basename(path))
+            stats.count("albums partially cached")
+        pending = []
+        subalbums = set()
+        for dir_entry in entries:
+            entry = dir_entry.path
+            if dir_entry.is_dir():
+                if not self.walks(entry):
+                    subalbums.add(trim_base(entry))
+                    album.add_album(Album.from_summary(entry, self.state.summary(trim_base(entry))))
+                    continue
+                next_walked_album = self.walk(entry, dir_entry.stat())
                 if next_walked_album is not None:
+                    subalbums.add(next_walked_album.path)
                     album.add_album(next_walked_album)
-            elif not cached and os.path.isfile(entry):
+                    if next_walked_album.path in self.changed_albums:
+                        changed = True
+            elif dir_entry.is_file():
+                if self.shard is not None and scan_shard(trim_base(entry), self.shard[1]) != self.shard[0]:
+                    continue
                 next_level()
-                cache_hit = False
-                if cached_album:
-                    cached_photo = cached_album.photo_from_path(entry)
-                    if cached_photo and file_mtime(entry) <= cached_photo.attributes["dateTimeFile"]:
+                stat = dir_entry.stat()
+                cached_photo = cached_photos.pop(trim_base(entry), None)
+                cache_hit, content_hash = photo_hit(entry, stat, cached_photo, self.validate)
+                if cache_hit and content_hash is not None:
+                    self.manifest.set_photo_mtime(trim_base(entry), int(stat.st_mtime))
+                if cache_hit:
+                    if changed:
                         message("cache hit", os.path.basename(entry))
-                        cache_hit = True
-                        photo = cached_photo
-                if not cache_hit:
-                    message("metainfo", os.path.basename(entry))
-                    photo = Photo(entry, self.cache_path)
-                if photo.is_valid:
-                    self.all_photos.append(photo)
-                    album.add_photo(photo)
+                    stats.count("cache hits")
+                    with stats.timer("cache load"):
+                        attributes = Manifest.attributes(cached_photo[2])
+                    if attributes is not None:
+                        # already validated, tell Photo not to look at the file mtime
+                        self.add_photo(album, Photo(entry, None, attributes, attributes["dateTimeFile"]), entry)
+                        thumbs = Manifest.thumbs(cached_photo[3])
+                        if len(thumbs) < len(Photo.thumb_caches(trim_base(entry))):
+                            # views left over by a scan that ran out of time
+                            self.deferred_views.append((entry, stat, missing_views(trim_base(entry), thumbs)))
+                    else:
+                        message("unreadable", os.path.basename(entry))
+                        stats.count("unreadable photos")
+                    back_level()
+                    continue
+                changed = True
+                stats.count("cache misses")
+                if self.validate == "hash":
+                    known = reusable_photo(self.manifest, trim_base(entry), stat, content_hash, lambda name: os.path.exists(os.path.join(self.cache_path, name)))
+                    if known is not None:
+                        photo = self.reuse_photo(entry, stat, known)
+                        self.record_photo(photo, stat, content_hash)
+                        self.add_photo(album, photo, entry)
+                        back_level()
+                        continue
+                with stats.timer("cache load"):
+                    missing = thumbs_to_make(trim_base(entry), stat, self.cache_entries, self.validate, self.thumbs_encoded)
+                if missing and self.out_of_time():
+                    self.leave_photo(album, entry, cached_photo)
+                    back_level()
+                    continue
+                if self.validate == "hash":
+                    for thumb in Photo.thumb_caches(trim_base(entry)):
+                        if self.cache_entries.pop(thumb, None) is not None:
+                            os.unlink(os.path.join(self.cache_path, thumb))
+                message("metainfo", os.path.basename(entry))
+                views = []
+                if self.deadline is not None:
+                    views = [size for size in missing if not size[1]]
+                    missing = [size for size in missing if size[1]]
+                if self.pool is not None:
+                    future = self.pool.submit(scan_photo_in_worker, entry, self.cache_path, stat_mtime(stat), missing)
+                    pending.append((entry, stat, content_hash, views, message.level, future))
+                    self.in_flight.add(future)
+                    if len(self.in_flight) > self.max_in_flight:
+                        # don't let the walk run ahead of the pool
+                        self.in_flight = wait(self.in_flight, return_when=FIRST_COMPLETED).not_done
+                        self.drain()
                 else:
-                    message("unreadable", os.path.basename(entry))
+                    photo = scan_photo(entry, self.cache_path, stat_mtime(stat), missing)
+                    self.record_photo(photo, stat, content_hash, views)
+                    self.add_photo(album, photo, entry)
                 back_level()
-        if not album.empty:
-            message("caching", os.path.basename(path))
-            album.cache(self.cache_path)
-            self.all_albums.append(album)
-        else:
-            message("empty", os.path.basename(path))
+        if cached_photos:
+            # photos deleted since the last scan, forgotten only at the end so
+            # that photos moved to albums walked later can still reuse them
+            changed = True
+            self.removed_photos.extend(cached_photos.keys())
+        if self.walk_paths is not None:
+            self.removed_files.extend(self.state.prune(album.path, subalbums))
+        if changed:
+            self.changed_albums.add(album.path)
+        self.pending_albums.append((album, path, album_mtime, message.level, pending))
+        self.drain()
         back_level()
         return album
 
+    # whether a directory has to be walked, or is known well enough as it was
+    def walks(self, path):
+        path = trim_base(path)
+        return self.walk_paths is None or path in self.walk_paths or path not in self.state.albums
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    # A photo left for the next scan: a new one is left out of its album, one
+    # already published stays as recorded, with its thumbnails. Its row isn't
+    # touched, the next scan finds it changed again.
+    def leave_photo(self, album, entry, cached_photo):
+        message("out of time", os.path.basename(entry))
+        stats.count("photos left for the next scan")
+        if cached_photo is not None and cached_photo[2] is not None:
+            attributes = Manifest.attributes(cached_photo[2])
+            album.add_photo(Photo(entry, None, attributes, attributes["dateTimeFile"]))
+
+    def record_photo(self, photo, stat, content_hash=None, views=()):
+        if photo.is_valid:
+            thumbs = photo.image_caches
+            if views:
+                pending = set(Photo.thumb_caches(photo.path, views))
+                thumbs = [thumb for thumb in thumbs if thumb not in pending]
+                self.deferred_views.append((untrim_base(photo.path), stat, views))
+            self.manifest.set_photo(photo.path, os.path.dirname(photo.path), stat.st_size, int(stat.st_mtime), photo.attributes, thumbs, content_hash)
+        else:
+            self.manifest.set_photo(photo.path, os.path.dirname(photo.path), stat.st_size, int(stat.st_mtime), None, [], content_hash)
+
+    def reuse_photo(self, entry, stat, known):
+        attributes, sources = known
+        targets = Photo.thumb_caches(trim_base(entry))
+        message("reusing", os.path.basename(entry))
+        stats.count("photos reused")
+        for source, target in zip(sources, targets):
+            if source != target:
+                target = os.path.join(self.cache_path, target)
+                make_parent(target)
+                shutil.copyfile(os.path.join(self.cache_path, source), temporary_path(target))
+                os.replace(temporary_path(target), target)
+        attributes = Manifest.attributes(attributes)
+        attributes["dateTimeFile"] = stat_mtime(stat)
+        return Photo(entry, None, attributes, stat_mtime(stat))
+
+    def add_photo(self, album, photo, entry):
+        if photo.is_valid:
+            album.add_photo(photo)
+        else:
+            message("unreadable", os.path.basename(entry))
+            stats.count("unreadable photos")
+
+    def checkpoint(self):
+        # The manifest only says an album is unchanged once its JSON is
+        # written: albums still open may miss changes already recorded for
+        # their photos or subalbums, the next scan has to write them again.
+        for path in self.open_albums:
+            self.manifest.forget_album(path)
+        self.manifest.commit()
+        self.last_checkpoint = time.monotonic()
+
+    def checkpoint_if_due(self):
+        if time.monotonic() - self.last_checkpoint > TreeWalker.checkpoint_interval:
+            message("checkpoint", "")
+            self.checkpoint()
+
+    def cache_album(self, album, path, mtime):
+        files = set()
+        for photo in album.photos:
+            files.update(photo.image_caches)
+        if album.empty:
+            message("empty", os.path.basename(path))
+        elif self.shard is None:
+            cache_paths = [name for cache in album.cache_paths(self.page_size) for name in json_files(cache)]
+            files.update(cache_paths)
+            # the album JSON is only ever written, unchanged albums keep theirs
+            if album.path in self.changed_albums or not all(cache in self.cache_entries for cache in cache_paths):
+                message("caching", os.path.basename(path))
+                with stats.timer("json write"):
+                    album.cache(self.cache_path, self.page_size)
+                stats.count("albums written")
+        self.manifest.set_album(album.path, mtime)
+        self.open_albums.discard(album.path)
+        photos = [photo.path for photo in album.photos]
+        records = [Indexes.record(photo) for photo in album.photos]
+        album.release()
+        self.state.set_album(album.path, album.summary, photos, files, records)
+
+    def drain(self, block=False):
+        # caches the leading pending albums whose photos are done, as soon as
+        # possible so that their photos don't stay in memory
+        # logging at the levels the walk had
+        current = message.level
+        while self.pending_albums:
+            album, path, mtime, level, pending = self.pending_albums[0]
+            if not block and not all(future.done() for *_, future in pending):
+                break
+            self.pending_albums.popleft()
+            for entry, stat, content_hash, views, photo_level, future in pending:
+                message.level = photo_level
+                photo = self.photo_result(future)
+                self.in_flight.discard(future)
+                self.record_photo(photo, stat, content_hash, views)
+                self.add_photo(album, photo, entry)
+            message.level = level
+            self.cache_album(album, path, mtime)
+            self.checkpoint_if_due()
+        message.level = current
+
+    def deferred_thumbnails(self):
+        # albums are all written, whatever is left now only delays the views
+        if not self.deferred_views:
+            return
+        message("thumbing", f"views of {len(self.deferred_views)} photos")
+        done = 0
+        futures = set()
+        for entry, stat, views in self.deferred_views:
+            if self.out_of_time():
+                break
+            if self.pool is None:
+                self.record_views(scan_photo(entry, self.cache_path, stat_mtime(stat), views))
+            else:
+                futures.add(self.pool.submit(scan_photo_in_worker, entry, self.cache_path, stat_mtime(stat), views))
+                if len(futures) > self.max_in_flight:
+                    finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.record_views(self.photo_result(future))
+            done += 1
+        for future in futures:
+            self.record_views(self.photo_result(future))
+        if done < len(self.deferred_views):
+            message("out of time", f"views of {len(self.deferred_views) - done} photos left for the next scan")
+
+    @staticmethod
+    def photo_result(future):
+        photo, worker_stats, log = future.result()
+        stats.merge(worker_stats)
+        print_messages(log)
+        return photo
+
+    def record_views(self, photo):
+        if photo.is_valid:
+            self.manifest.set_photo_thumbs(photo.path, photo.image_caches)
+        self.checkpoint_if_due()
+
+    # seconds per album walked, per photo scanned and decoded and per
+    # thumbnail, as measured so far: what plans estimate scans from
+    def record_throughput(self):
+        throughput = json.loads(self.manifest.get_meta("throughput") or "{}")
+        for name, phases, counter in (("album", ("walk", "cache load", "json write"), "albums walked"),
+                                      ("photo", ("exif",), "photos scanned"),
+                                      ("decode", ("decode",), "photos decoded"),
+                                      ("thumbnail", ("resize", "encode"), "thumbnails written")):
+            if stats.counters.get(counter):
+                throughput[name] = sum(stats.timers.get(phase, 0) for phase in phases) / stats.counters[counter]
+        self.manifest.set_meta("throughput", json.dumps(throughput))
+
     def big_lists(self):
-        photo_list = []
-        self.all_photos.sort()
-        for photo in self.all_photos:
-            photo_list.append(photo.path)
+        # sorted by name, like the photos, and by path among namesakes
+        photo_list = sorted(self.state.photos(), key=lambda path: (os.path.basename(path), path))
         message("caching", "all photos path list")
-        with open(os.path.join(self.cache_path, "all_photos.json"), 'w') as fp:
-            json.dump(photo_list, fp, cls=PhotoAlbumEncoder)
+        write_json(os.path.join(self.cache_path, "all_photos.json"), photo_list)
+        # tells the web client where to find the albums and how to read them
+        write_json(os.path.join(self.cache_path, "layout.json"), {"sharded": self.sharded, "compact": self.compact})
+        self.indexes.write(self.cache_path, self.state.records())
+
+    # the directories of the cache holding album and photo files
+    def all_shards(self):
+        shards = [""]
+        if self.sharded:
+            for first in sorted(os.listdir(self.cache_path)):
+                if is_shard(first) and os.path.isdir(os.path.join(self.cache_path, first)):
+                    shards.extend(first + "/" + second for second in sorted(os.listdir(os.path.join(self.cache_path, first))))
+        return shards
 
     def remove_stale(self):
         message("cleanup", "building stale list")
-        all_cache_entries = {"all_photos.json": True, "latest_photos.json": True}
-        for album in self.all_albums:
-            all_cache_entries[album.cache_path] = True
-        for photo in self.all_photos:
-            for entry in photo.image_caches:
-                all_cache_entries[entry] = True
+        all_cache_entries = set(self.state.files())
+        for name in top_files:
+            all_cache_entries.update(json_files(name))
+        if self.walk_paths is None:
+            shards = self.all_shards()
+        else:
+            # only where this scan may have left stale files: the shards it
+            # looked at and those of the photos and albums removed
+            shards = set(self.cache_entries.shards())
+            shards.update(os.path.dirname(cache) for cache in self.removed_files)
+            for path in self.removed_photos:
+                shards.update(os.path.dirname(cache) for cache in Photo.thumb_caches(path))
         message("cleanup", "searching for stale cache entries")
-        for cache in os.listdir(self.cache_path):
-            try:
-                cache = cache  # No decoding needed in Python 3
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                pass
-            if cache not in all_cache_entries:
-                message("cleanup", os.path.basename(cache))
-                os.unlink(os.path.join(self.cache_path, cache))
+        # one shard at a time, anything written during this scan is in all_cache_entries anyway
+        for shard in sorted(shards):
+            entries = self.cache_entries.shard(shard)
+            for name in list(entries):
+                cache = os.path.join(shard, name)
+                if cache not in all_cache_entries:
+                    message("cleanup", name)
+                    stats.count("stale files removed")
+                    os.unlink(os.path.join(self.cache_path, cache))
+                    del entries[name]
+            if shard and not entries:
+                try:
+                    os.removedirs(os.path.join(self.cache_path, shard))
+                except OSError:
+                    pass
+
@@ -0,0 +1,178 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from TreeWalker import TreeWalker, ScanState
+from CachePath import *
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+# Linux inotify, through libc: one watch per directory of the album tree.
+# Reports the directories whose entries were added, removed, renamed or
+# written to, or None when the kernel dropped events and anything may have
+# changed.
+class Inotify:
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    event = struct.Struct("iIII")
+
+    def __init__(self, album_path):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self._watches = {}
+        try:
+            self.add_tree(album_path)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def add_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), Inotify.mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # removed meanwhile, its parent reports it
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                # e.g. ENOSPC, over fs.inotify.max_user_watches
+                raise OSError(error, os.strerror(error), dirpath)
+            self._watches[wd] = dirpath
+
+    def remove_tree(self, path):
+        for wd, dirpath in list(self._watches.items()):
+            if dirpath == path or dirpath.startswith(path + "/"):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def changes(self, timeout):
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self._fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = Inotify.event.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + Inotify.event.size:offset + Inotify.event.size + length].rstrip(b"\0"))
+            offset += Inotify.event.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            path = self._watches.get(wd)
+            if path is None or name.startswith('.'):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR:
+                # a directory moved within the tree is watched again under its new name
+                if mask & IN_MOVED_FROM:
+                    self.remove_tree(os.path.join(path, name))
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(os.path.join(path, name))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+# Fallback where inotify isn't available: compares the mtimes of all the
+# directories of the tree every few seconds, one stat per directory. Adding,
+# removing or renaming photos changes the mtime of their directory, editing
+# one in place does not and is only picked up by the next full scan.
+class Poller:
+    interval = 2
+
+    def __init__(self, album_path):
+        self._album_path = album_path
+        self._mtimes = self._snapshot()
+
+    def _snapshot(self):
+        mtimes = {}
+        stack = [self._album_path]
+        while stack:
+            path = stack.pop()
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if not entry.name.startswith('.') and entry.is_dir():
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return mtimes
+
+    def changes(self, timeout):
+        time.sleep(min(timeout, Poller.interval))
+        mtimes = self._snapshot()
+        # new directories are changed, removed ones show in their parent's mtime
+        changed = set(path for path, mtime in mtimes.items() if self._mtimes.get(path) != mtime)
+        self._mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+# Scans the whole tree once, then keeps watching it: as soon as changes
+# settle, only the directories changed and their ancestors are walked again,
+# the albums left alone stand in with what the previous scans knew of them.
+class Watcher:
+    # seconds without changes before rescanning, so that a batch of photos
+    # being copied makes a single scan
+    settle = 0.3
+
+    def __init__(self, album_path, cache_path, options):
+        self.album_path = os.path.abspath(album_path)
+        self.cache_path = cache_path
+        self.options = options
+        # watching from before the first scan, what changes during it is rescanned next
+        try:
+            self.source = Inotify(self.album_path)
+        except (AttributeError, OSError) as e:
+            message("watch", "inotify unavailable ({}), polling".format(e))
+            self.source = Poller(self.album_path)
+
+    def run(self):
+        try:
+            state = self.scan(ScanState(), None)
+            while True:
+                message("watching", self.album_path)
+                changed = self.wait()
+                if changed is None:
+                    message("watch", "events lost, rescanning everything")
+                    state = self.scan(ScanState(), None)
+                else:
+                    state = self.scan(state, changed)
+        finally:
+            self.source.close()
+
+    def wait(self):
+        changed = set()
+        while not changed:
+            changed = self.source.changes(3600)
+            if changed is None:
+                return None
+        while True:
+            more = self.source.changes(Watcher.settle)
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed.update(more)
+
+    def scan(self, state, changed):
+        TreeWalker(self.album_path, self.cache_path, state=state, changed=changed, **self.options)
+        return state
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Times the scanner on a synthetic album tree, generated reproducibly from a
+# seed: a cold scan, a scan with nothing changed, a rescan after touching all
+# photos and a rescan after adding a photo to one album. Each phase runs
+# main.py in a process of its own, for its wall time and peak RSS. Results
+# are written as JSON, and can be compared with the results of another run:
+#
+#   ./benchmark.py -o before.json -- -j 4
+#   ./benchmark.py -o after.json --compare before.json -- -j 4
+
+from PIL import Image, ImageDraw, ExifTags
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import PIL
+
+cameras = [("Canon", "Canon EOS 5D Mark III"), ("NIKON CORPORATION", "NIKON D750"), ("Apple", "iPhone 12"), ("FUJIFILM", "X-T3")]
+artists = ["Alice", "Bob", "Carol", "Dave"]
+
+def size(text):
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: " + text)
+    return (width, height)
+
+def make_photo(path, rng, index, resolution):
+    # gradients and shapes: compresses and decodes about like a real photo
+    width, height = resolution
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge("RGB", (gradient, noise, gradient.rotate(180)))
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse((x, y, x + rng.randrange(width // 4 + 1), y + rng.randrange(height // 4 + 1)), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    make, model = cameras[index % len(cameras)]
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = rng.randint(1, 8)
+    exif[ExifTags.Base.Artist] = rng.choice(artists)
+    exif[ExifTags.Base.Make] = make
+    exif[ExifTags.Base.Model] = model
+    date = datetime(2015, 1, 1) + timedelta(hours=rng.randrange(24 * 365 * 5))
+    exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.DateTimeOriginal] = date.strftime("%Y:%m:%d %H:%M:%S")
+    image.save(path, "JPEG", quality=85, exif=exif)
+
+# depth levels of width albums each, photos in every album
+def generate(root, config):
+    rng = random.Random(config["seed"])
+    albums = [root]
+    level = [root]
+    for depth in range(config["depth"]):
+        level = [os.path.join(parent, "album %d-%d" % (depth, i)) for parent in level for i in range(config["width"])]
+        albums.extend(level)
+    index = 0
+    for album in albums:
+        os.makedirs(album, exist_ok=True)
+        for i in range(config["photos"]):
+            make_photo(os.path.join(album, "IMG_%04d.jpg" % i), rng, index, config["resolution"])
+            index += 1
+
+def count_photos(root):
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        count += sum(1 for name in filenames if name.endswith(".jpg"))
+    return count
+
+def scan(album_path, cache_path, scanner_args, log):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")] + scanner_args + [album_path, cache_path]
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    # the usage of this scan only: its process and its worker processes
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.monotonic() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("scan failed: " + " ".join(command))
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss
+
+def touch_all(root):
+    # later than anything scanned, whatever the clock resolution
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(".jpg"):
+                path = os.path.join(dirpath, name)
+                mtime = os.stat(path).st_mtime + 10
+                os.utime(path, (mtime, mtime))
+
+def run_phases(album_path, albums, work_path, config, scanner_args, log):
+    cache_path = os.path.join(work_path, "cache")
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.mkdir(cache_path)
+    results = {}
+    results["cold"] = scan(album_path, cache_path, scanner_args, log)
+    results["warm"] = scan(album_path, cache_path, scanner_args, log)
+    touch_all(album_path)
+    results["touch"] = scan(album_path, cache_path, scanner_args, log)
+    # one new photo in the deepest album, taken out again for the next repetitions
+    added = os.path.join(albums[-1], "IMG_new.jpg")
+    make_photo(added, random.Random(config["seed"]), 0, config["resolution"])
+    try:
+        results["change"] = scan(album_path, cache_path, scanner_args, log)
+    finally:
+        os.unlink(added)
+    return results
+
+def compare(report, baseline):
+    previous = dict((phase["name"], phase) for phase in baseline["phases"])
+    print("{:8} {:>10} {:>10} {:>8} {:>12} {:>12}".format("phase", "before", "after", "ratio", "RSS before", "RSS after"), file=sys.stderr)
+    for phase in report["phases"]:
+        before = previous.get(phase["name"])
+        if before is None:
+            continue
+        print("{:8} {:>9.3f}s {:>9.3f}s {:>8.2f} {:>10}kB {:>10}kB".format(phase["name"], before["seconds"], phase["seconds"], phase["seconds"] / before["seconds"], before["peak_rss_kb"], phase["peak_rss_kb"]), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="times the scanner on a synthetic album tree")
+    parser.add_argument("--work", default=None, metavar="PATH",
+                        help="directory for the album tree and the cache, kept and reused while the tree "
+                        "settings don't change (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--depth", type=int, default=2, help="levels of albums below the root (default: 2)")
+    parser.add_argument("--width", type=int, default=3, help="subalbums of every album (default: 3)")
+    parser.add_argument("--photos", type=int, default=10, help="photos in every album (default: 10)")
+    parser.add_argument("--resolution", type=size, default=(1600, 1200), metavar="WxH",
+                        help="size of the photos (default: 1600x1200)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated tree (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs of all phases, the median time and largest RSS are reported (default: 1)")
+    parser.add_argument("-o", "--output", default=None, metavar="FILE", help="where to write the JSON results (default: stdout)")
+    parser.add_argument("--compare", default=None, metavar="FILE", help="results of an earlier run to compare with")
+    parser.add_argument("scanner_args", nargs=argparse.REMAINDER, metavar="-- SCANNER_ARGS",
+                        help="options passed to main.py, e.g. -- -j 4 --formats jpg,webp")
+    args = parser.parse_args()
+    scanner_args = args.scanner_args
+    if scanner_args[:1] == ["--"]:
+        scanner_args = scanner_args[1:]
+    config = {"depth": args.depth, "width": args.width, "photos": args.photos, "resolution": list(args.resolution), "seed": args.seed}
+
+    work_path = args.work
+    if work_path is None:
+        work_path = tempfile.mkdtemp(prefix="photofloat-benchmark-")
+    os.makedirs(work_path, exist_ok=True)
+    try:
+        album_path = os.path.join(work_path, "albums")
+        stamp_path = os.path.join(work_path, "tree.json")
+        try:
+            with open(stamp_path) as fp:
+                fresh = json.load(fp) == config
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            print("generating the album tree", file=sys.stderr)
+            shutil.rmtree(album_path, ignore_errors=True)
+            generate(album_path, config)
+            with open(stamp_path, "w") as fp:
+                json.dump(config, fp)
+        # shallowest first
+        albums = sorted((dirpath for dirpath, dirnames, filenames in os.walk(album_path)), key=lambda path: (path.count(os.sep), path))
+        photos = count_photos(album_path)
+
+        samples = {}
+        with open(os.path.join(work_path, "scan.log"), "w") as log:
+            for repetition in range(max(1, args.repeat)):
+                print("run {} of {}: {} photos in {} albums".format(repetition + 1, max(1, args.repeat), photos, len(albums)), file=sys.stderr)
+                for name, sample in run_phases(album_path, albums, work_path, config, scanner_args, log).items():
+                    samples.setdefault(name, []).append(sample)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    phases = []
+    for name, runs in samples.items():
+        seconds = statistics.median(run[0] for run in runs)
+        phases.append({
+            "name": name,
+            "seconds": round(seconds, 4),
+            "runs": [round(run[0], 4) for run in runs],
+            "photos": photos,
+            "photos_per_second": round(photos / seconds, 2),
+            "peak_rss_kb": max(run[1] for run in runs),
+        })
+    report = {
+        "config": config,
+        "scanner_args": scanner_args,
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "phases": phases,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    for phase in phases:
+        print("{:8} {:>9.3f}s {:>10.1f} photos/s {:>10} kB".format(phase["name"], phase["seconds"], phase["photos_per_second"], phase["peak_rss_kb"]), file=sys.stderr)
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            compare(report, json.load(fp))
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,160 @@
 #!/usr/bin/env python3
 
 from TreeWalker import TreeWalker
+from Watcher import Watcher
+from ShardMerge import merge_shards
+from Planner import Planner
+from PhotoAlbum import Photo
 from CachePath import message
+from FileSystem import atomic_write, supported_compressions
+from Stats import stats
+from datetime import datetime
+import argparse
+import cProfile
+import json
+import signal
 import sys
 import os
+import time
+
+def duration(text):
+    # 90, 90s, 20m, 1.5h
+    units = {"s": 1, "m": 60, "h": 3600}
+    try:
+        if text[-1:] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid duration: " + text)
+
+def shard(text):
+    # i/N, 0 <= i < N
+    try:
+        index, count = (int(value) for value in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid shard: " + text)
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("invalid shard: " + text)
+    return (index, count)
+
+def terminate(signum, frame):
+    # e.g. a CI job hitting its time limit: stop like on CTRL+C
+    raise KeyboardInterrupt
+
+def write_report(path, started, seconds, interrupted, plan=None):
+    report = {"command": sys.argv, "started": started.isoformat(timespec="seconds"), "seconds": round(seconds, 4), "interrupted": interrupted}
+    report.update(stats.report())
+    if plan is not None:
+        report["plan"] = plan.report()
+    atomic_write(path, json.dumps(report, indent=2))
 
 def main():
-    if len(sys.argv) != 3:
-        print("usage: {} ALBUM_PATH CACHE_PATH".format(sys.argv[0]))
-        return
+    parser = argparse.ArgumentParser()
+    parser.add_argument("album_path", metavar="ALBUM_PATH")
+    parser.add_argument("cache_path", metavar="CACHE_PATH")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes generating thumbnails (default: number of CPUs)")
+    parser.add_argument("--validate", choices=["mtime", "hash"], default="mtime",
+                        help="how cached photos are checked: by modification time, or by content hash "
+                        "when mtimes can't be trusted (e.g. fresh git checkouts). By mtime, a photo merely "
+                        "touched is decoded and thumbnailed again; by hash, it only costs reading it to "
+                        "compare contents. Hashing also lets copied or renamed photos reuse their thumbnails")
+    parser.add_argument("--list-threads", type=int, default=8,
+                        help="number of threads listing directories ahead of the scan (default: 8)")
+    parser.add_argument("--page-size", type=int, default=0,
+                        help="split albums with more photos than this into a light index and pages "
+                        "of full photo details loaded on demand (default: 0, never split)")
+    parser.add_argument("--formats", default="jpg",
+                        help="comma separated thumbnail formats among " + ", ".join(Photo.save_formats) + "; "
+                        "JPEG is always written, browsers pick the best other one they support (default: jpg)")
+    parser.add_argument("--progressive", action="store_true",
+                        help="write progressive, optimized JPEG thumbnails")
+    parser.add_argument("--latest", type=int, default=100,
+                        help="number of photos listed in latest_photos.json (default: 100)")
+    parser.add_argument("--time-budget", type=duration, default=None, metavar="DURATION",
+                        help="stop thumbnailing after this long (e.g. 90s, 20m, 1h): the grid thumbnails "
+                        "of all photos are made first, then the views; what's left is done by the next scans")
+    parser.add_argument("--sharded", action="store_true",
+                        help="spread album and thumbnail files over two levels of hashed subdirectories "
+                        "of the cache, for very large albums; a cache written in the other layout is moved over")
+    parser.add_argument("--compact", action="store_true",
+                        help="write the JSON files without spaces and with short keys, the web client expands them")
+    parser.add_argument("--compress", default="",
+                        help="comma separated compressed copies to write next to every JSON file, among gz and br "
+                        "(needs the brotli module), for static hosts serving them as they are (default: none)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running after the scan and rescan the albums changed since, as soon as they "
+                        "change (inotify on Linux, polling directories every few seconds elsewhere)")
+    parser.add_argument("--shard", type=shard, default=None, metavar="I/N",
+                        help="only scan the photos of shard I of N (0 <= I < N), picked by a hash of their path; "
+                        "no album JSON is written, merge the caches of all N shards into one with --merge")
+    parser.add_argument("--merge", action="append", default=[], metavar="SHARD_CACHE",
+                        help="before scanning, bring the thumbnails and metadata from the cache of a shard into "
+                        "CACHE_PATH; repeat for every shard. The shards must have seen the same files and used "
+                        "the same thumbnail options")
+    parser.add_argument("--plan", action="store_true",
+                        help="don't scan, tell what a scan with these options would do and estimate how long it "
+                        "would take, from the stats of the files and the cache only (with --validate hash, photos with a new "
+                        "mtime or new are read too); the details are logged, "
+                        "and written to the --report file")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't log every album, photo and thumbnail")
+    parser.add_argument("--report", default=None, metavar="FILE",
+                        help="write a JSON report of the scan at exit: time spent per phase, counters, "
+                        "slowest photos and albums")
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="profile the scan with cProfile and write the stats to FILE, for pstats or snakeviz "
+                        "(worker processes aren't profiled, use -j 1 to include thumbnailing)")
+    args = parser.parse_args()
+    formats = args.formats.split(",")
+    for extension in formats:
+        if extension not in Photo.save_formats:
+            parser.error("unknown thumbnail format: " + extension)
+    compress = [extension for extension in args.compress.split(",") if extension]
+    for extension in compress:
+        if extension not in ("gz", "br"):
+            parser.error("unknown compression: " + extension)
+    if args.shard is not None and (args.watch or args.merge):
+        parser.error("--shard can't be combined with --watch or --merge")
+    if args.plan and (args.watch or args.merge or args.shard is not None):
+        parser.error("--plan can't be combined with --watch, --merge or --shard")
+    signal.signal(signal.SIGTERM, terminate)
+    message.quiet = args.quiet
+    started = datetime.now()
+    start = time.monotonic()
+    interrupted = False
+    plan = None
+    profile = None
+    if args.profile is not None:
+        profile = cProfile.Profile()
+        profile.enable()
     try:
         os.umask(0o22)
-        TreeWalker(sys.argv[1], sys.argv[2])
+        options = dict(jobs=max(1, args.jobs), validate=args.validate, list_threads=max(1, args.list_threads), page_size=max(0, args.page_size),
+                       thumb_formats=Photo.supported_formats(formats), progressive=args.progressive, latest=max(0, args.latest), time_budget=args.time_budget, sharded=args.sharded,
+                       compact=args.compact, compress=supported_compressions(compress))
+        if args.plan:
+            plan = Planner(args.album_path, args.cache_path, options["jobs"], args.validate, options["page_size"], options["thumb_formats"], args.progressive, args.sharded, args.compact, options["compress"])
+            plan.log()
+            for line in plan.summary():
+                print(line)
+            return
+        if args.merge:
+            merge_shards(args.merge, args.cache_path, options["thumb_formats"], options["progressive"], options["sharded"])
+        if args.watch:
+            Watcher(args.album_path, args.cache_path, options).run()
+        else:
+            TreeWalker(args.album_path, args.cache_path, shard=args.shard, **options)
     except KeyboardInterrupt:
+        interrupted = True
         message("keyboard", "CTRL+C pressed, quitting.")
         sys.exit(-97)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.report is not None:
+            write_report(args.report, started, time.monotonic() - start, interrupted, plan)
 
 if __name__ == "__main__":
     main()
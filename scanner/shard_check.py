@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Checks on a single machine that a tree scanned by shards and merged ends up
+# cached exactly like a tree scanned in one go: first from scratch, then
+# after a photo is edited in place, which changes neither its name nor the
+# mtime of its directory. The shards run in parallel, each one with a cache
+# of its own, as they would on several machines. Exits with 1 if the caches
+# differ.
+#
+#   ./shard_check.py --shards 3 -- -j 2 --sharded
+
+from benchmark import generate, make_photo, size
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+def scanner_command(args):
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")] + args
+
+def scan(args, log):
+    if subprocess.call(scanner_command(args), stdout=log, stderr=subprocess.STDOUT) != 0:
+        raise RuntimeError("scan failed: " + " ".join(args))
+
+def scan_shards(album_path, work_path, count, scanner_args, log):
+    shard_paths = [os.path.join(work_path, "shard%d" % index) for index in range(count)]
+    processes = []
+    for index, shard_path in enumerate(shard_paths):
+        os.makedirs(shard_path, exist_ok=True)
+        processes.append(subprocess.Popen(scanner_command(scanner_args + ["--shard", "%d/%d" % (index, count), album_path, shard_path]), stdout=log, stderr=subprocess.STDOUT))
+    for process in processes:
+        if process.wait() != 0:
+            raise RuntimeError("shard scan failed")
+    merge = []
+    for shard_path in shard_paths:
+        merge += ["--merge", shard_path]
+    os.makedirs(os.path.join(work_path, "merged"), exist_ok=True)
+    scan(scanner_args + merge + [album_path, os.path.join(work_path, "merged")], log)
+
+# {path: contents} of the JSON files of a cache, None for the other files
+def cache_files(cache_path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(cache_path):
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(dirpath, name)
+            contents = None
+            if name.endswith(".json"):
+                with open(path) as fp:
+                    contents = json.load(fp)
+            files[os.path.relpath(path, cache_path)] = contents
+    return files
+
+def differences(expected_path, actual_path):
+    expected = cache_files(expected_path)
+    actual = cache_files(actual_path)
+    found = ["missing: " + path for path in sorted(set(expected) - set(actual))]
+    found += ["unexpected: " + path for path in sorted(set(actual) - set(expected))]
+    found += ["differs: " + path for path in sorted(set(expected) & set(actual)) if expected[path] != actual[path]]
+    return found
+
+def edit_in_place(album_path, config):
+    # another picture in the same file: the directory isn't touched
+    albums = sorted(dirpath for dirpath, dirnames, filenames in os.walk(album_path) if dirpath != album_path)
+    path = os.path.join(albums[0], "IMG_0001.jpg")
+    directory = os.stat(albums[0])
+    width, height = config["resolution"]
+    make_photo(path, random.Random(config["seed"] + 1), 1, (height, width))
+    mtime = os.stat(path).st_mtime + 10
+    os.utime(path, (mtime, mtime))
+    os.utime(albums[0], ns=(directory.st_atime_ns, directory.st_mtime_ns))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="checks that scanning in shards and merging gives the same cache as a single scan")
+    parser.add_argument("--shards", type=int, default=3, help="number of shards (default: 3)")
+    parser.add_argument("--work", default=None, metavar="PATH",
+                        help="directory for the album tree and the caches, kept afterwards (default: a temporary directory, removed)")
+    parser.add_argument("--depth", type=int, default=2, help="levels of albums below the root (default: 2)")
+    parser.add_argument("--width", type=int, default=2, help="subalbums of every album (default: 2)")
+    parser.add_argument("--photos", type=int, default=4, help="photos in every album (default: 4)")
+    parser.add_argument("--resolution", type=size, default=(320, 240), metavar="WxH", help="size of the photos (default: 320x240)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated tree (default: 1)")
+    parser.add_argument("scanner_args", nargs=argparse.REMAINDER, metavar="-- SCANNER_ARGS",
+                        help="options passed to every scan, e.g. -- -j 2 --sharded")
+    args = parser.parse_args()
+    scanner_args = args.scanner_args
+    if scanner_args[:1] == ["--"]:
+        scanner_args = scanner_args[1:]
+    config = {"depth": args.depth, "width": args.width, "photos": args.photos, "resolution": list(args.resolution), "seed": args.seed}
+
+    work_path = args.work
+    if work_path is None:
+        work_path = tempfile.mkdtemp(prefix="photofloat-shards-")
+    failed = False
+    try:
+        album_path = os.path.join(work_path, "albums")
+        shutil.rmtree(album_path, ignore_errors=True)
+        for name in os.listdir(work_path) if os.path.isdir(work_path) else []:
+            if name == "single" or name == "merged" or name.startswith("shard"):
+                shutil.rmtree(os.path.join(work_path, name))
+        generate(album_path, config)
+        os.makedirs(os.path.join(work_path, "single"))
+        with open(os.path.join(work_path, "scan.log"), "w") as log:
+            for step in ("scan", "edit in place"):
+                if step == "edit in place":
+                    print("editing " + os.path.relpath(edit_in_place(album_path, config), album_path), file=sys.stderr)
+                scan(scanner_args + [album_path, os.path.join(work_path, "single")], log)
+                scan_shards(album_path, work_path, args.shards, scanner_args, log)
+                found = differences(os.path.join(work_path, "single"), os.path.join(work_path, "merged"))
+                print("{}: {}".format(step, "same caches" if not found else "caches differ"), file=sys.stderr)
+                for difference in found:
+                    print("  " + difference, file=sys.stderr)
+                failed = failed or bool(found)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work_path, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
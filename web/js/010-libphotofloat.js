@@ -1,12 +1,47 @@
 (function() {
+	/* least recently used cache, keeping at most size values */
+	function Cache(size) {
+		this.size = size;
+		this.values = {};
+		this.keys = [];
+	}
+	Cache.prototype.get = function(key) {
+		if (!this.values.hasOwnProperty(key))
+			return undefined;
+		this.keys.splice(this.keys.indexOf(key), 1);
+		this.keys.push(key);
+		return this.values[key];
+	};
+	Cache.prototype.put = function(key, value) {
+		if (this.values.hasOwnProperty(key))
+			this.keys.splice(this.keys.indexOf(key), 1);
+		this.keys.push(key);
+		this.values[key] = value;
+		while (this.keys.length > this.size)
+			delete this.values[this.keys.shift()];
+	};
+	
 	/* constructor */
 	function PhotoFloat() {
-		this.albumCache = [];
+		this.albumCache = new Cache(PhotoFloat.albumCacheSize);
+		this.albumRequests = {};
+		this.indexCache = new Cache(PhotoFloat.albumCacheSize);
+		this.prefetchQueue = [];
+		this.prefetching = 0;
+		/* caches without layout.json predate the sharded layout and the compact format */
+		this.layoutRequest = $.ajax({
+			type: "GET",
+			dataType: "json",
+			url: "cache/layout.json"
+		}).done(function(layout) {
+			PhotoFloat.sharded = layout.sharded === true;
+			PhotoFloat.compact = layout.compact === true;
+		});
 	}
 	
 	/* public member functions */
 	PhotoFloat.prototype.album = function(subalbum, callback, error) {
-		var cacheKey, ajaxOptions, self;
+		var cacheKey, album, request, fetch, self;
 		if (typeof subalbum.photos !== "undefined" && subalbum.photos !== null) {
 			callback(subalbum);
 			return;
@@ -15,23 +50,146 @@
 			cacheKey = subalbum;
 		else
 			cacheKey = PhotoFloat.cachePath(subalbum.parent.path + "/" + subalbum.path);
-		if (this.albumCache.hasOwnProperty(cacheKey)) {
-			callback(this.albumCache[cacheKey]);
+		album = this.albumCache.get(cacheKey);
+		if (typeof album !== "undefined") {
+			callback(album);
 			return;
 		}
 		self = this;
-		ajaxOptions = {
-			type: "GET",
-			dataType: "json",
-			url: "cache/" + cacheKey + ".json",
-			success: function(album) {
+		/* an album already on its way, e.g. prefetched, isn't requested twice */
+		request = this.albumRequests[cacheKey];
+		if (typeof request === "undefined") {
+			/* the album can only be found once the cache layout is known */
+			fetch = function() {
+				return $.ajax({
+					type: "GET",
+					dataType: "json",
+					converters: { "text json": PhotoFloat.parseJSON },
+					url: PhotoFloat.cacheFile(cacheKey, ".json")
+				});
+			};
+			request = this.albumRequests[cacheKey] = this.layoutRequest.then(fetch, fetch);
+			request.done(function(album) {
 				var i;
 				for (i = 0; i < album.albums.length; ++i)
 					album.albums[i].parent = album;
-				for (i = 0; i < album.photos.length; ++i)
+				for (i = 0; i < album.photos.length; ++i) {
 					album.photos[i].parent = album;
-				self.albumCache[cacheKey] = album;
-				callback(album);
+					if (typeof album.pages !== "undefined")
+						album.photos[i].page = Math.floor(i / album.pageSize);
+				}
+				self.albumCache.put(cacheKey, album);
+			});
+			request.always(function() {
+				delete self.albumRequests[cacheKey];
+			});
+		}
+		request.done(function(album) {
+			callback(album);
+		});
+		if (typeof error !== "undefined" && error !== null) {
+			request.fail(function(jqXHR) {
+				error(jqXHR.status);
+			});
+		}
+	};
+	/* replaces whatever wasn't prefetched yet: images first, then albums, a few at a time */
+	PhotoFloat.prototype.prefetch = function(images, albums) {
+		var i, self = this;
+		this.prefetchQueue = [];
+		for (i = 0; i < images.length; ++i) {
+			(function(url) {
+				self.prefetchQueue.push(function(done) {
+					var image = new Image();
+					image.onload = image.onerror = done;
+					image.src = url;
+				});
+			})(images[i]);
+		}
+		for (i = 0; i < albums.length; ++i) {
+			(function(album) {
+				self.prefetchQueue.push(function(done) {
+					self.album(album, done, done);
+				});
+			})(albums[i]);
+		}
+		this.prefetchNext();
+	};
+	PhotoFloat.prototype.prefetchNext = function() {
+		var self = this;
+		while (this.prefetching < PhotoFloat.prefetchConcurrency && this.prefetchQueue.length) {
+			this.prefetching++;
+			this.prefetchQueue.shift()(function() {
+				self.prefetching--;
+				self.prefetchNext();
+			});
+		}
+	};
+	PhotoFloat.prototype.photoDetails = function(album, photo, callback, error) {
+		var page, request, ajaxOptions;
+		if (photo === null || typeof photo.page === "undefined") {
+			callback();
+			return;
+		}
+		page = photo.page;
+		if (typeof album.pageRequests === "undefined")
+			album.pageRequests = [];
+		request = album.pageRequests[page];
+		if (typeof request === "undefined") {
+			ajaxOptions = {
+				type: "GET",
+				dataType: "json",
+				converters: { "text json": PhotoFloat.parseJSON },
+				url: PhotoFloat.cacheFile(PhotoFloat.cachePath(album.path), ".page" + page + ".json"),
+				success: function(details) {
+					var i, photos = {};
+					/* photos may have been dropped from the album since it was loaded */
+					for (i = 0; i < album.photos.length; ++i)
+						photos[album.photos[i].name] = album.photos[i];
+					for (i = 0; i < details.photos.length; ++i) {
+						if (photos.hasOwnProperty(details.photos[i].name))
+							$.extend(photos[details.photos[i].name], details.photos[i]);
+					}
+				}
+			};
+			request = album.pageRequests[page] = $.ajax(ajaxOptions);
+			request.fail(function() {
+				delete album.pageRequests[page];
+			});
+		}
+		request.done(function() {
+			callback();
+		});
+		if (typeof error !== "undefined" && error !== null) {
+			request.fail(function(jqXHR) {
+				error(jqXHR.status);
+			});
+		}
+	};
+	/* precomputed indexes: "latest_photos", "index/timeline", "index/timeline-YYYY-MM", "index/cameras", "index/camera-KEY" */
+	PhotoFloat.prototype.index = function(name, callback, error) {
+		var ajaxOptions, self;
+		if (typeof this.indexCache.get(name) !== "undefined") {
+			callback(this.indexCache.get(name));
+			return;
+		}
+		self = this;
+		ajaxOptions = {
+			type: "GET",
+			dataType: "json",
+			converters: { "text json": PhotoFloat.parseJSON },
+			url: "cache/" + name + ".json",
+			success: function(index) {
+				var i;
+				/* entries only know the cache key of their album, enough for photoPath and photoHash */
+				for (i = 0; i < index.length; ++i) {
+					if (typeof index[i].photo !== "undefined")
+						index[i].photo.parent = { path: index[i].photo.album, photos: [] };
+					else
+						index[i].parent = { path: index[i].album, photos: [] };
+				}
+				self.indexCache.put(name, index);
+				callback(index);
 			}
 		};
 		if (typeof error !== "undefined" && error !== null) {
@@ -39,10 +197,19 @@
 				error(jqXHR.status);
 			};
 		}
-		$.ajax(ajaxOptions);
+		/* the keys can only be read once the format is known */
+		this.layoutRequest.always(function() {
+			$.ajax(ajaxOptions);
+		});
 	};
 	PhotoFloat.prototype.albumPhoto = function(subalbum, callback, error) {
-		var nextAlbum, self;
+		var nextAlbum, self, photo;
+		/* subalbums come with a sample of their photos, no need to walk down to one */
+		if (typeof subalbum.sample !== "undefined" && subalbum.sample.length) {
+			photo = subalbum.sample[Math.floor(Math.random() * subalbum.sample.length)];
+			callback({ path: photo.album, photos: [], formats: subalbum.parent.formats }, photo);
+			return;
+		}
 		self = this;
 		nextAlbum = function(album) {
 			var index = Math.floor(Math.random() * (album.photos.length + album.albums.length));
@@ -58,7 +225,7 @@
 			this.album(subalbum, nextAlbum, error);
 	};
 	PhotoFloat.prototype.parseHash = function(hash, callback, error) {
-		var index, album, photo;
+		var index, album, photo, self;
 		hash = PhotoFloat.cleanHash(hash);
 		index = hash.lastIndexOf("/");
 		if (!hash.length) {
@@ -71,6 +238,7 @@
 			album = hash;
 			photo = null;
 		}
+		self = this;
 		this.album(album, function(theAlbum) {
 			var i = -1;
 			if (photo !== null) {
@@ -85,7 +253,10 @@
 					i = -1;
 				}
 			}
-			callback(theAlbum, photo, i);
+			/* big albums only list their photos, fetch the details of the shown one */
+			self.photoDetails(theAlbum, photo, function() {
+				callback(theAlbum, photo, i);
+			}, error);
 		}, error);
 	};
 	PhotoFloat.prototype.authenticate = function(password, result) {
@@ -129,6 +300,43 @@
 			path = path.replace(/__/g, "_");
 		return path;
 	};
+	/* same two level subdirectories as the scanner, from a 32 bit FNV-1a hash of the cache key */
+	PhotoFloat.cacheShard = function(key) {
+		var i, hash;
+		if (!PhotoFloat.sharded)
+			return "";
+		hash = 0x811c9dc5;
+		for (i = 0; i < key.length; ++i)
+			hash = Math.imul(hash ^ key.charCodeAt(i), 0x01000193) >>> 0;
+		hash = ("0000000" + hash.toString(16)).slice(-8);
+		return hash.substring(0, 2) + "/" + hash.substring(2, 4) + "/";
+	};
+	PhotoFloat.cacheFile = function(key, suffix) {
+		return "cache/" + PhotoFloat.cacheShard(key) + key + suffix;
+	};
+	/* compact caches write short keys, maps them back */
+	PhotoFloat.expandKeys = function(value) {
+		var i, key, expanded;
+		if ($.isArray(value)) {
+			for (i = 0; i < value.length; ++i)
+				value[i] = PhotoFloat.expandKeys(value[i]);
+			return value;
+		}
+		if (value === null || typeof value !== "object")
+			return value;
+		expanded = {};
+		for (key in value) {
+			if (value.hasOwnProperty(key))
+				expanded[PhotoFloat.longKeys.hasOwnProperty(key) ? PhotoFloat.longKeys[key] : key] = PhotoFloat.expandKeys(value[key]);
+		}
+		return expanded;
+	};
+	PhotoFloat.parseJSON = function(text) {
+		var value = $.parseJSON(text);
+		if (PhotoFloat.compact)
+			return PhotoFloat.expandKeys(value);
+		return value;
+	};
 	PhotoFloat.photoHash = function(album, photo) {
 		return PhotoFloat.albumHash(album) + "/" + PhotoFloat.cachePath(photo.name);
 	};
@@ -137,16 +345,50 @@
 			return PhotoFloat.cachePath(album.path);
 		return PhotoFloat.cachePath(album.parent.path + "/" + album.path);
 	};
-	PhotoFloat.photoPath = function(album, photo, size, square) {
+	PhotoFloat.photoPath = function(album, photo, size, square, format) {
 		var suffix, hash;
 		if (square)
 			suffix = size.toString() + "s";
 		else
 			suffix = size.toString();
-		hash = PhotoFloat.cachePath(PhotoFloat.photoHash(album, photo) + "_" + suffix + ".jpg");
+		if (typeof format === "undefined")
+			format = "jpg";
+		hash = PhotoFloat.cachePath(PhotoFloat.photoHash(album, photo));
 		if (hash.indexOf("root-") === 0)
 			hash = hash.substring(5);
-		return "cache/" + hash;
+		return PhotoFloat.cacheFile(hash, "_" + suffix + "." + format);
+	};
+	PhotoFloat.photoSrcset = function(album, photo, sizes, square, format) {
+		var i, scale, srcset = [];
+		if (!$.isArray(sizes))
+			return PhotoFloat.photoPath(album, photo, sizes, square, format);
+		for (i = 0; i < sizes.length; ++i) {
+			/* the scanner never scales photos up */
+			scale = Math.min(1, sizes[i] / Math.max(photo.size[0], photo.size[1]));
+			srcset.push(PhotoFloat.photoPath(album, photo, sizes[i], square, format) + " " + Math.round(photo.size[0] * scale) + "w");
+		}
+		return srcset.join(", ");
+	};
+	PhotoFloat.photoSources = function(album, photo, sizes, square) {
+		var i, sources = "";
+		if (typeof album.formats === "undefined")
+			return sources;
+		/* the scanner lists the formats by order of preference, JPEG being the fallback */
+		for (i = 0; i < album.formats.length; ++i) {
+			if (album.formats[i] !== "jpg")
+				sources += "<source type=\"image/" + album.formats[i] + "\" srcset=\"" + PhotoFloat.photoSrcset(album, photo, sizes, square, album.formats[i]) + "\" />";
+		}
+		return sources;
+	};
+	PhotoFloat.bestFormat = function(album) {
+		var i;
+		if (typeof album.formats === "undefined")
+			return "jpg";
+		for (i = 0; i < album.formats.length; ++i) {
+			if (album.formats[i] !== "jpg" && PhotoFloat.supportedFormats[album.formats[i]] === true)
+				return album.formats[i];
+		}
+		return "jpg";
 	};
 	PhotoFloat.originalPhotoPath = function(album, photo) {
 		return "albums/" + album.path + "/" + photo.name;
@@ -175,11 +417,49 @@
 		return hash;
 	};
 	
+	/* static members */
+	PhotoFloat.albumCacheSize = 50;
+	PhotoFloat.prefetchConcurrency = 2;
+	PhotoFloat.viewSizes = [640, 800, 1024];
+	PhotoFloat.supportedFormats = { jpg: true };
+	PhotoFloat.sharded = false;
+	PhotoFloat.compact = false;
+	/* same table as short_keys in the scanner, the other way around */
+	PhotoFloat.longKeys = {
+		v: "version", p: "path", d: "date", f: "formats", a: "albums", ph: "photos",
+		ps: "pageSize", pg: "pages", g: "page", c: "count", sa: "sample", al: "album",
+		n: "name", mo: "month", pt: "photo", ca: "camera", k: "key",
+		tf: "dateTimeFile", sz: "size", o: "orientation", ar: "artist", cr: "copyright",
+		mk: "make", md: "model", ap: "aperture", fl: "focalLength", is: "iso",
+		et: "exposureTime", fh: "flash", ls: "lightSource", ep: "exposureProgram",
+		ss: "spectralSensitivity", mm: "meteringMode", sm: "sensingMethod",
+		sc: "sceneCaptureType", sd: "subjectDistanceRange", ec: "exposureCompensation",
+		to: "dateTimeOriginal", dt: "dateTime"
+	};
+	(function() {
+		/* for the image urls built outside of <picture>, e.g. backgrounds and preloads */
+		var tests = {
+			webp: "UklGRiQAAABXRUJQVlA4IBgAAAAwAQCdASoBAAEAAsBMJaQAA3AA/vgfgAA=",
+			avif: "AAAAIGZ0eXBhdmlmAAAAAGF2aWZtaWYxbWlhZk1BMUIAAADrbWV0YQAAAAAAAAAhaGRscgAAAAAAAAAAcGljdAAAAAAAAAAAAAAAAAAAAAAOcGl0bQAAAAAAAQAAAB5pbG9jAAAAAEQAAAEAAQAAAAEAAAETAAAAIQAAAChpaW5mAAAAAAABAAAAGmluZmUCAAAAAAEAAGF2MDFDb2xvcgAAAABqaXBycAAAAEtpcGNvAAAAFGlzcGUAAAAAAAAAAQAAAAEAAAAQcGl4aQAAAAADCAgIAAAADGF2MUOBAAwAAAAAE2NvbHJuY2x4AAEADQAGgAAAABdpcG1hAAAAAAAAAAEAAQQBAoMEAAAAKW1kYXQSAAoIGAAGiAhoNCAyExlHh4Yhh5555oAAAJBAyRxhQr4="
+		};
+		$.each(tests, function(format, data) {
+			var image = new Image();
+			image.onload = function() {
+				PhotoFloat.supportedFormats[format] = image.width > 0;
+			};
+			image.src = "data:image/" + format + ";base64," + data;
+		});
+	}());
+	
 	/* make static methods callable as member functions */
 	PhotoFloat.prototype.cachePath = PhotoFloat.cachePath;
+	PhotoFloat.prototype.cacheFile = PhotoFloat.cacheFile;
 	PhotoFloat.prototype.photoHash = PhotoFloat.photoHash;
 	PhotoFloat.prototype.albumHash = PhotoFloat.albumHash;
 	PhotoFloat.prototype.photoPath = PhotoFloat.photoPath;
+	PhotoFloat.prototype.photoSrcset = PhotoFloat.photoSrcset;
+	PhotoFloat.prototype.photoSources = PhotoFloat.photoSources;
+	PhotoFloat.prototype.bestFormat = PhotoFloat.bestFormat;
 	PhotoFloat.prototype.originalPhotoPath = PhotoFloat.originalPhotoPath;
 	PhotoFloat.prototype.trimExtension = PhotoFloat.trimExtension;
 	PhotoFloat.prototype.cleanHash = PhotoFloat.cleanHash;
@@ -28,6 +28,23 @@ $(document).ready(function() {
 	var originalTitle = document.title;
 	var photoFloat = new PhotoFloat();
 	var maxSize = 800;
+	var prefetchedAlbums = 4;
+	var thumbSize = 150;
+	var thumbsOverscan = 2;
+	var renderedThumbs = {};
+	var thumbsScheduled = false;
+	var thumbsObserver = null;
+	if (typeof window.IntersectionObserver !== "undefined") {
+		thumbsObserver = new IntersectionObserver(function(entries) {
+			var i;
+			for (i = 0; i < entries.length; ++i) {
+				if (entries[i].isIntersecting) {
+					thumbsObserver.unobserve(entries[i].target);
+					fillThumb($(entries[i].target));
+				}
+			}
+		}, { rootMargin: thumbSize + "px" });
+	}
 	
 	
 	/* Displays */
@@ -62,66 +79,142 @@ $(document).ready(function() {
 		document.title = documentTitle;
 	}
 	function scrollToThumb() {
-		var photo, thumb;
+		var photo, index, thumbsElement, scroller;
 		photo = currentPhoto;
 		if (photo === null) {
 			photo = previousPhoto;
 			if (photo === null)
 				return;
 		}
-		$("#thumbs img").each(function() {
-			if (this.photo === photo) {
-				thumb = $(this);
-				return false;
-			}
-		});
-		if (typeof thumb === "undefined")
+		/* the thumbnail may not exist yet, its position is known anyway */
+		index = currentAlbum.photos.indexOf(photo);
+		if (index === -1)
 			return;
+		thumbsElement = $("#thumbs");
 		if (currentPhoto !== null) {
-			var scroller = $("#album-view");
-			scroller.stop().animate({ scrollLeft: thumb.position().left + scroller.scrollLeft() - scroller.width() / 2 + thumb.width() / 2 }, "slow");
+			scroller = $("#album-view");
+			scroller.stop().animate({ scrollLeft: thumbsElement.offset().left - scroller.offset().left + scroller.scrollLeft() + index * thumbSize - scroller.width() / 2 + thumbSize / 2 }, "slow");
 		} else
-			$("html, body").stop().animate({ scrollTop: thumb.offset().top - $(window).height() / 2 + thumb.height() }, "slow");
+			$("html, body").stop().animate({ scrollTop: thumbsElement.offset().top + Math.floor(index / thumbsColumns()) * thumbSize - $(window).height() / 2 + thumbSize }, "slow");
 		
 		if (currentPhoto !== null) {
 			$("#thumbs img").removeClass("current-thumb");
-			thumb.addClass("current-thumb");
+			$("#thumbs img").each(function() {
+				if (this.photo === photo) {
+					$(this).addClass("current-thumb");
+					return false;
+				}
+			});
 		}
 	}
+	
+	/*
+	 * The thumbnails grid is virtualized: #thumbs is sized for all the
+	 * photos, but only the tiles around the visible part exist, placed
+	 * where they belong. A tile gets its image once it scrolls into
+	 * view, or right away with native lazy loading in browsers without
+	 * IntersectionObserver.
+	 */
+	function thumbsColumns() {
+		if ($("#album-view").hasClass("photo-view-container"))
+			return currentAlbum.photos.length;
+		return Math.max(1, Math.floor($("#album-view").width() / thumbSize));
+	}
+	function fillThumb(link) {
+		var image, picture, photo = link.get(0).photo, album = currentAlbum;
+		image = $("<img title=\"" + photoFloat.trimExtension(photo.name) + "\" alt=\"" + photoFloat.trimExtension(photo.name) + "\" src=\"" + photoFloat.photoPath(album, photo, 150, true) + "\" height=\"150\" width=\"150\" loading=\"lazy\" />");
+		image.get(0).photo = photo;
+		if (photo === currentPhoto)
+			image.addClass("current-thumb");
+		picture = $("<picture>" + photoFloat.photoSources(album, photo, 150, true) + "</picture>");
+		picture.append(image);
+		link.append(picture);
+		image.error(function() {
+			if (album.photos.indexOf(photo) !== -1)
+				album.photos.splice(album.photos.indexOf(photo), 1);
+			if (album === currentAlbum)
+				resetThumbs();
+		});
+	}
+	function renderThumbs() {
+		var i, link, thumbsElement, scroller, count, columns, first, last, horizontal, overscan;
+		if (currentAlbum === null)
+			return;
+		thumbsElement = $("#thumbs");
+		count = currentAlbum.photos.length;
+		columns = thumbsColumns();
+		horizontal = $("#album-view").hasClass("photo-view-container");
+		if (horizontal) {
+			scroller = $("#album-view");
+			thumbsElement.css("width", count * thumbSize).css("height", thumbSize);
+			first = Math.floor((scroller.offset().left - thumbsElement.offset().left) / thumbSize);
+			last = first + Math.ceil(scroller.width() / thumbSize);
+		} else {
+			thumbsElement.css("width", "").css("height", Math.ceil(count / columns) * thumbSize);
+			first = Math.floor(($(window).scrollTop() - thumbsElement.offset().top) / thumbSize) * columns;
+			last = first + (Math.ceil($(window).height() / thumbSize) + 1) * columns - 1;
+		}
+		/* a few more tiles, or rows, on both sides */
+		overscan = horizontal ? thumbsOverscan : thumbsOverscan * columns;
+		first = Math.max(0, first - overscan);
+		last = Math.min(count - 1, last + overscan);
+		for (i in renderedThumbs) {
+			if (renderedThumbs.hasOwnProperty(i) && (i < first || i > last)) {
+				if (thumbsObserver !== null)
+					thumbsObserver.unobserve(renderedThumbs[i].get(0));
+				renderedThumbs[i].remove();
+				delete renderedThumbs[i];
+			}
+		}
+		for (i = first; i <= last; ++i) {
+			link = renderedThumbs[i];
+			if (typeof link === "undefined") {
+				link = renderedThumbs[i] = $("<a class=\"thumb\" href=\"#!/" + photoFloat.photoHash(currentAlbum, currentAlbum.photos[i]) + "\"></a>");
+				link.get(0).photo = currentAlbum.photos[i];
+				thumbsElement.append(link);
+				if (thumbsObserver !== null)
+					thumbsObserver.observe(link.get(0));
+				else
+					fillThumb(link);
+			}
+			link.css("left", (i % columns) * thumbSize).css("top", Math.floor(i / columns) * thumbSize);
+		}
+	}
+	function resetThumbs() {
+		if (thumbsObserver !== null)
+			thumbsObserver.disconnect();
+		$("#thumbs").empty();
+		renderedThumbs = {};
+		scheduleThumbs();
+	}
+	function scheduleThumbs() {
+		if (thumbsScheduled)
+			return;
+		thumbsScheduled = true;
+		(window.requestAnimationFrame ? function(callback) { window.requestAnimationFrame(callback); } : setTimeout)(function() {
+			thumbsScheduled = false;
+			renderThumbs();
+		});
+	}
+	
 	function showAlbum(populate) {
-		var i, link, image, photos, thumbsElement, subalbums, subalbumsElement;
+		var i, link, image, thumbsElement, subalbums, subalbumsElement;
 		if (currentPhoto === null && previousPhoto === null)
 			$("html, body").stop().animate({ scrollTop: 0 }, "slow");
 		
 		if (populate) {
-			photos = [];
-			for (i = 0; i < currentAlbum.photos.length; ++i) {
-				link = $("<a href=\"#!/" + photoFloat.photoHash(currentAlbum, currentAlbum.photos[i]) + "\"></a>");
-				image = $("<img title=\"" + photoFloat.trimExtension(currentAlbum.photos[i].name) + "\" alt=\"" + photoFloat.trimExtension(currentAlbum.photos[i].name) + "\" src=\"" + photoFloat.photoPath(currentAlbum, currentAlbum.photos[i], 150, true) + "\" height=\"150\" width=\"150\" />");
-				image.get(0).photo = currentAlbum.photos[i];
-				link.append(image);
-				photos.push(link);
-				(function(theLink, theImage, theAlbum) {
-					theImage.error(function() {
-						photos.splice(photos.indexOf(theLink), 1);
-						theLink.remove();
-						theAlbum.photos.splice(theAlbum.photos.indexOf(theImage.get(0).photo), 1);
-					});
-				})(link, image, currentAlbum);
-			}
 			thumbsElement = $("#thumbs");
-			thumbsElement.empty();
-			thumbsElement.append.apply(thumbsElement, photos);
+			resetThumbs();
 			
 			subalbums = [];
 			for (i = currentAlbum.albums.length - 1; i >= 0; --i) {
 				link = $("<a href=\"#!/" + photoFloat.albumHash(currentAlbum.albums[i]) + "\"></a>");
-				image = $("<div title=\"" + currentAlbum.albums[i].date + "\" class=\"album-button\">" + currentAlbum.albums[i].path + "</div>");
+				image = $("<div title=\"" + getDate(currentAlbum.albums[i].date) + "\" class=\"album-button\">" + currentAlbum.albums[i].path + "</div>");
 				link.append(image);
 				subalbums.push(link);
 				(function(theContainer, theAlbum, theImage, theLink) {
 					photoFloat.albumPhoto(theAlbum, function(album, photo) {
-						theImage.css("background-image", "url(" + photoFloat.photoPath(album, photo, 150, true) + ")");
+						theImage.css("background-image", "url(" + photoFloat.photoPath(album, photo, 150, true, photoFloat.bestFormat(album)) + ")");
 					}, function error() {
 						theContainer.albums.splice(currentAlbum.albums.indexOf(theAlbum), 1);
 						theLink.remove();
@@ -141,18 +234,29 @@ $(document).ready(function() {
 		}
 		
 		if (currentPhoto === null) {
+			/* the subalbums shown first are the likeliest to be opened next */
+			photoFloat.prefetch([], currentAlbum.albums.slice(-prefetchedAlbums).reverse());
 			$("#thumbs img").removeClass("current-thumb");
 			$("#album-view").removeClass("photo-view-container");
 			$("#subalbums").show();
 			$("#photo-view").hide();
 		}
+		scheduleThumbs();
 		setTimeout(scrollToThumb, 1);
 	}
 	function getDecimal(fraction) {
+		if (typeof fraction === "number") {
+			if (fraction > 0 && fraction < 1)
+				return "1/" + Math.round(1 / fraction);
+			return (Math.round(fraction * 100) / 100).toString();
+		}
 		if (fraction[0] < fraction[1])
 			return fraction[0] + "/" + fraction[1];
 		return (fraction[0] / fraction[1]).toString();
 	}
+	function getDate(date) {
+		return date.replace("T", " ");
+	}
 	function scaleImage() {
 		var image, container;
 		image = $("#photo");
@@ -163,6 +267,9 @@ $(document).ready(function() {
 			image.css("width", "100%").css("height", "auto").css("position", "absolute").css("bottom", 0);
 		else if (image.css("height") !== "100%")
 			image.css("height", "100%").css("width", "auto").css("position", "").css("bottom", "");
+		/* lets the browser pick the view size matching the screen density */
+		if (image.width() > 0)
+			image.siblings("source").andSelf().attr("sizes", Math.round(image.width()) + "px");
 	}
 	function showPhoto() {
 		var width, height, photoSrc, previousPhoto, nextPhoto, nextLink, text;
@@ -177,12 +284,17 @@ $(document).ready(function() {
 		}
 		$(window).unbind("resize", scaleImage);
 		photoSrc = photoFloat.photoPath(currentAlbum, currentPhoto, maxSize, false);
+		$("#photo").siblings("source").remove();
 		$("#photo")
+			.before(photoFloat.photoSources(currentAlbum, currentPhoto, photoFloat.viewSizes, false))
 			.attr("width", width).attr("height", height).attr("ratio", currentPhoto.size[0] / currentPhoto.size[1])
+			.attr("sizes", Math.round(width) + "px")
+			.attr("srcset", photoFloat.photoSrcset(currentAlbum, currentPhoto, photoFloat.viewSizes, false))
 			.attr("src", photoSrc)
 			.attr("alt", currentPhoto.name)
-			.attr("title", currentPhoto.date)
+			.attr("title", getDate(currentPhoto.date))
 			.load(scaleImage);
+		$("#photo").siblings("source").attr("sizes", Math.round(width) + "px");
 		$("head").append("<link rel=\"image_src\" href=\"" + photoSrc + "\" />");
 		
 		previousPhoto = currentAlbum.photos[
@@ -191,7 +303,11 @@ $(document).ready(function() {
 		nextPhoto = currentAlbum.photos[
 			(currentPhotoIndex + 1 >= currentAlbum.photos.length) ? 0 : (currentPhotoIndex + 1)
 		];
-		$.preloadImages(photoFloat.photoPath(currentAlbum, nextPhoto, maxSize, false), photoFloat.photoPath(currentAlbum, previousPhoto, maxSize, false));
+		photoFloat.prefetch([
+			photoFloat.photoPath(currentAlbum, nextPhoto, maxSize, false, photoFloat.bestFormat(currentAlbum)),
+			photoFloat.photoPath(currentAlbum, previousPhoto, maxSize, false, photoFloat.bestFormat(currentAlbum))
+		], []);
+		photoFloat.photoDetails(currentAlbum, nextPhoto, function() {});
 		
 		nextLink = "#!/" + photoFloat.photoHash(currentAlbum, nextPhoto);
 		$("#next-photo").attr("href", nextLink);
@@ -204,7 +320,7 @@ $(document).ready(function() {
 		if (typeof currentPhoto.copyright !== "undefined") text += "<tr><td>License</td><td>" + currentPhoto.copyright + "</td></tr>";
 		if (typeof currentPhoto.make !== "undefined") text += "<tr><td>Camera Maker</td><td>" + currentPhoto.make + "</td></tr>";
 		if (typeof currentPhoto.model !== "undefined") text += "<tr><td>Camera Model</td><td>" + currentPhoto.model + "</td></tr>";
-		if (typeof currentPhoto.date !== "undefined") text += "<tr><td>Time Taken</td><td>" + currentPhoto.date + "</td></tr>";
+		if (typeof currentPhoto.date !== "undefined") text += "<tr><td>Time Taken</td><td>" + getDate(currentPhoto.date) + "</td></tr>";
 		if (typeof currentPhoto.size !== "undefined") text += "<tr><td>Resolution</td><td>" + currentPhoto.size[0] + " x " + currentPhoto.size[1] + "</td></tr>";
 		if (typeof currentPhoto.aperture !== "undefined") text += "<tr><td>Aperture</td><td> f/" + getDecimal(currentPhoto.aperture) + "</td></tr>";
 		if (typeof currentPhoto.focalLength !== "undefined") text += "<tr><td>Focal Length</td><td>" + getDecimal(currentPhoto.focalLength) + " mm</td></tr>";
@@ -225,6 +341,7 @@ $(document).ready(function() {
 		$("#album-view").addClass("photo-view-container");
 		$("#subalbums").hide();
 		$("#photo-view").show();
+		scheduleThumbs();
 	}
 	
 	
@@ -266,6 +383,8 @@ $(document).ready(function() {
 	
 	/* Event listeners */
 	
+	$(window).scroll(scheduleThumbs).resize(scheduleThumbs);
+	$("#album-view").scroll(scheduleThumbs);
 	$(window).hashchange(function() {
 		$("#loading").show();
 		$("link[rel=image_src]").remove();